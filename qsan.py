@@ -1,6 +1,17 @@
 # encoding: utf8
 import argparse
+import collections
+import cProfile
+import datetime
+import errno
+import fcntl
+import gzip
+import hashlib
+import os
+import subprocess
 import sys
+import threading
+import time
 import requests
 import json
 from requests.exceptions import (ConnectionError, ConnectTimeout, Timeout,
@@ -9,8 +20,78 @@ from requests.exceptions import (ConnectionError, ConnectTimeout, Timeout,
                                  ContentDecodingError, StreamConsumedError,
                                  UnrewindableBodyError, RequestException,
                                  ProxyError, SSLError, MissingSchema)
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
 from bs4 import BeautifulSoup
 
+try:
+    from types import MappingProxyType as _frozendict
+except ImportError:
+    # Python 2
+    _frozendict = dict
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
+
+try:
+    from urllib.parse import urlsplit, parse_qsl, urlencode
+except ImportError:
+    # Python 2
+    from urlparse import urlsplit, parse_qsl
+    from urllib import urlencode
+
+
+# One collection pass of QSAN.snapshot()
+Snapshot = collections.namedtuple('Snapshot', [
+    'host',           # QSAN IP-address or FQDN
+    'clock',          # Unix timestamp of collection start
+    'sanos_version',  # 3 or 4
+    'storage',        # {'iops': '', 'read': '', 'write': ''}
+    'volumes',        # {id: SnapshotItem}
+    'disks',          # {id: SnapshotItem}
+    'fc_ports',       # {'slot:port': SnapshotItem}
+    'cache_pools'     # {name: SnapshotItem}
+])
+
+# Volume, Disk, FC port or Cache Pool in Snapshot
+SnapshotItem = collections.namedtuple('SnapshotItem', [
+    'id',         # id in QSAN
+    'name',       # name used in Zabbix discovery
+    'inventory',  # attributes got by discovery
+    'stats'       # stats of the same collection pass
+])
+
+# Object types used in Zabbix keys and their Snapshot fields
+_SNAPSHOT_TYPES = [
+    ('volume', 'volumes'),
+    ('disk', 'disks'),
+    ('fcport', 'fc_ports'),
+    ('cachepool', 'cache_pools')
+]
+
+
+# Discovered attributes sent as items: (type used in Zabbix keys,
+# discovered objects, naming method, attributes)
+_INVENTORY_ITEMS = [
+    ('volume', '_VDs', '_get_VD_name_by_id', ['status', 'health']),
+    ('disk', '_DISKs', '_get_DISK_name_by_id', ['health', 'rate', 'fw_ver']),
+    ('fcport', '_FCs', '_get_FC_port_name_by_id', ['status', 'data_rate'])
+]
+
+
+def _zabbix_value(value):
+    """
+    Quoting value for zabbix_sender input if it has spaces
+    Returns: Link Up -> "Link Up"
+    """
+    if value and (value[0] == '"' or len(value.split()) > 1):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    return value
+
 
 def argumentsparsing():
     """
@@ -18,9 +99,10 @@ def argumentsparsing():
     parser = argparse.ArgumentParser()
     parser.add_argument("--method", required=True, type=str, dest="method",
                         help="Available methods: discovery:volume, " +
-                             "discovery:disk, discovery:fc, discovery:cp,\n" +
+                             "discovery:disk, discovery:fc, discovery:cp, " +
+                             "discovery:all,\n" +
                              "stats:volume, stats:storage, stats:disk, " +
-                             "stats:cp, stats:all")
+                             "stats:cp, stats:all, stats:json, serve")
     parser.add_argument("--host", dest="host", required=True, type=str,
                         help="QSAN IP-address or FQDN")
     parser.add_argument("--username", type=str, dest="username",
@@ -31,13 +113,97 @@ def argumentsparsing():
                         help="QSAN user password [default: %(default)s]")
     parser.add_argument("--zhost", type=str, dest="zhost",
                         help="Storage name in Zabbix")
-
-    return parser.parse_args()
-
-
-class QSAN():
+    parser.add_argument("--record", type=str, dest="record", metavar="DIR",
+                        help="Record all requests and responses to DIR")
+    parser.add_argument("--replay", type=str, dest="replay", metavar="DIR",
+                        help="Serve responses recorded with --record DIR " +
+                             "instead of requesting storage")
+    parser.add_argument("--replay-latency", type=str, dest="replay_latency",
+                        default="original", choices=["original", "zero"],
+                        help="Delay replayed responses by recorded " +
+                             "response time or don't delay " +
+                             "[default: %(default)s]")
+    parser.add_argument("--profile", type=str, dest="profile",
+                        metavar="FILE",
+                        help="Profile the run, print time of phases to " +
+                             "stderr and write profile to FILE")
+    parser.add_argument("--profile-format", type=str, dest="profile_format",
+                        default="pstats", choices=["pstats", "collapsed"],
+                        help="cProfile dump or collapsed stacks for " +
+                             "flamegraphs [default: %(default)s]")
+    parser.add_argument("--format", type=str, dest="format",
+                        default="zabbix", choices=["zabbix", "jsonl"],
+                        help="Output format, jsonl streams QSAN.snapshot() " +
+                             "as JSON lines and supports only stats:all " +
+                             "method [default: %(default)s]")
+    parser.add_argument("--cache-dir", type=str, dest="cache_dir",
+                        default="/var/tmp/qsan-sanos4-zabbix-cache",
+                        help="Directory for discovery data and detected " +
+                             "storage capabilities reused by stats " +
+                             "methods, empty to disable. Not used with " +
+                             "--record and --replay [default: %(default)s]")
+    parser.add_argument("--cache-ttl", type=int, dest="cache_ttl",
+                        default=3600,
+                        help="Seconds stats methods reuse cached " +
+                             "discovery for, discovery methods always " +
+                             "refresh it [default: %(default)s]")
+    parser.add_argument("--discovery-heartbeat", type=int,
+                        dest="discovery_heartbeat", default=86400,
+                        help="discovery:all with --zserver sends " +
+                             "discovery only if it changed or this number " +
+                             "of seconds passed since it was delivered, " +
+                             "hashes of delivered discovery are kept in " +
+                             "--cache-dir [default: %(default)s]")
+    parser.add_argument("--socket", type=str, dest="socket",
+                        help="Unix domain socket serve method answers " +
+                             "with latest values of stats:all items on, " +
+                             "see qsan_get.py")
+    parser.add_argument("--interval", type=int, dest="interval",
+                        default=60,
+                        help="Seconds between collections of serve " +
+                             "method [default: %(default)s]")
+    parser.add_argument("--zserver", type=str, dest="zserver",
+                        help="Zabbix server or proxy to push stats to " +
+                             "with zabbix_sender. Stats are printed to " +
+                             "stdout if not set")
+    parser.add_argument("--zsender", type=str, dest="zsender",
+                        default="/usr/bin/zabbix_sender",
+                        help="Path to zabbix_sender [default: %(default)s]")
+    parser.add_argument("--spool-dir", type=str, dest="spool_dir",
+                        default="/var/tmp/qsan-sanos4-zabbix",
+                        help="Directory for stats which couldn't be " +
+                             "pushed to --zserver [default: %(default)s]")
+    parser.add_argument("--spool-max-bytes", type=int,
+                        dest="spool_max_bytes", default=52428800,
+                        help="Spool size limit per storage, oldest " +
+                             "batches are evicted [default: %(default)s]")
+    parser.add_argument("--spool-max-age", type=int, dest="spool_max_age",
+                        default=86400,
+                        help="Spooled batches older than this number of " +
+                             "seconds are evicted [default: %(default)s]")
+    parser.add_argument("--spool-chunk", type=int, dest="spool_chunk",
+                        default=1000,
+                        help="Max number of spooled values replayed with " +
+                             "one zabbix_sender run [default: %(default)s]")
+
+    args = parser.parse_args()
+
+    if args.format == 'jsonl' and args.method != 'stats:all':
+        parser.error('--format jsonl supports only stats:all method')
+
+    if args.method == 'serve' and not args.socket:
+        parser.error('serve method requires --socket')
+
+    if args.record and args.replay:
+        parser.error('--record and --replay are mutually exclusive')
+
+    return args
+
+
+class BaseQSAN():
     """
-    Class for operationing with qsan
+    Common part of QSAN and AsyncQSAN: URLs, parsing of responses and
+    naming of objects. Doesn't make any requests
     """
 
     # Common header for HTTP request
@@ -60,12 +226,9 @@ class QSAN():
 
     def __init__(self, host=None, username='user', password='1234'):
         """
-        Connecting to QSAN storage. Makinkg discovery of Volumes and Disks.
         """
         self._connection_timeout = 30
-        self._session = None
-        self._data = None
-        self._soup = None
+        self._host = host
         self._url = 'http://' + host
         self._url_path_login = '/login.php'
         self._url_path_data = '/monitor_x.php?cmd=monitor_dashboard'
@@ -91,114 +254,66 @@ class QSAN():
         self._DISKs = {}
         self._CPs = {}
         self._FCs = {}
-        self.connect()
-        self._sanos_version_detect()
-        self.vd_discovery()
-        self.disk_discovery()
-        self.cache_pool_discovery()
-        self.fc_discovery()
+        # Discovery was requested from storage, not taken from cache
+        self._discovery_fetched = False
+        # What storage supports. Everything is assumed until discovery
+        # detects it, see _detect_capabilities()
+        self._capabilities = {
+            'sanos_version': 4,
+            'controllers': ['0', '1'],  # Controllers answering fc_x.php
+            'fc': True,
+            'cache_pools': True,
+            'storage_stats': True
+        }
 
-    def _bs4(self, r):
+    def _bs4(self, text):
         """
         Common method for BeautifulSoup
         Returns: BeautifulSoup object
         """
-        return BeautifulSoup(r.text, 'lxml')
-
-    def _is_request_ok(self, r):
-        """
-        Checking HTTP respose status
-        Returns: bool
-        """
-
-        return (r.ok or r.status_code == 200 or r.status_code == 302)
-
-    def _connection_init(self):
-        """
-        Closing session and establishing new one
-        """
-        if self._session:
-            self._session.close()
-
-        self._session = requests.Session()
+        return BeautifulSoup(text, 'lxml')
 
-    def _connection(self, url, username, password, post=False, data=None):
+    def _login_keys(self):
         """
-        Main connection method
-        Returns: session object if got succesfull HTTP response
-        with _is_request_ok()
+        Returns: login form params with credentials
         """
-        if username:
-            self._LOGIN_KEYS['username'] = username
-        if password:
-            self._LOGIN_KEYS['password'] = password
-
-        try:
-            if post:
-                r = self._session.post(url,
-                                       headers=self._HEADERS,
-                                       timeout=self._connection_timeout,
-                                       data=data)
-            else:
-                r = self._session.get(url,
-                                      headers=self._HEADERS,
-                                      timeout=self._connection_timeout,
-                                      data=data)
-
-            self._soup = self._bs4(r)
-
-            if not self._is_request_ok(r):
-                raise RequestException('Something wrong with request')
-
-            return r
-        except (RequestException, ConnectionError, ConnectTimeout,
-                SSLError, MissingSchema, RetryError, ProxyError,
-                InvalidHeader, ReadTimeout, UnrewindableBodyError,
-                ChunkedEncodingError, HTTPError, StreamConsumedError,
-                Timeout, TooManyRedirects, ContentDecodingError) as e:
+        keys = dict(self._LOGIN_KEYS)
+        keys['username'] = self._username
+        keys['password'] = self._password
 
-            raise RequestException('Error making request: ' + str(e))
+        return keys
 
-    def _is_authorized(self, r):
+    def _is_authorized(self, soup):
         """
         Checking if LOGOUT div present on a page
         """
-        res = self._soup.find('div', id='logout_btn')
+        res = soup.find('div', id='logout_btn')
 
         # F600Q Support (SANOS3?)
         if not res:
-            res = self._soup.find('img', title='Logout')
+            res = soup.find('img', title='Logout')
 
         if res:
             return True
 
         return False
 
-    def _authorize(self):
-        """
-        Authorizing at QSAN management web-interface
-        Returns: bool with _is_authorized()
-        """
-        r = self._connection(self._url + self._url_path_login,
-                             username=self._username,
-                             password=self._password,
-                             post=True,
-                             data=self._LOGIN_KEYS)
-
-        return self._is_authorized(r)
-
-    def connect(self):
+    def _parse_sanos_version(self, soup):
         """
-        Common connect method
+        Detecting SANOS Version by login page
+        Returns: int(major_version, ex.: 3)
         """
-        self._connection_init()
+        version_lookup = soup.find('div', id='logo_writing')
+        if version_lookup:
+            if 'SANOS 4.0' not in version_lookup.text:
+                return 3
+        else:
+            return 3
 
-        if not self._authorize():
-            raise RequestException('Unable to authorize!')
+        return 4
 
-    def storage_stats(self):
+    def _parse_storage_stats(self, soup):
         """
-        Getting stats from dashboard
         Returns: {'iops': '10764', 'read': '282640625', 'write': '1255703125'}
         """
         stats = {
@@ -207,17 +322,12 @@ class QSAN():
             'rx': None
         }
 
-        self._connection(self._url + self._url_path_data,
-                         username=None,
-                         password=None,
-                         data=None)
-
         # SANOS3-based storages doesn't support storage stats
-        if not self._soup.response.controller:
+        if not soup.response.controller:
             return {}
 
         for s in stats:
-            value = self._soup.response.find(s).text.replace(',', '')
+            value = soup.response.find(s).text.replace(',', '')
             stats[s] = value
 
         stats['read'] = stats.pop('tx')
@@ -230,31 +340,23 @@ class QSAN():
 
         return stats
 
-    def _sanos_version_detect(self):
+    def _health_url(self):
         """
-        Detecting SANOS Version
-        Sets self._SANOS_VERSION with int(major_version, ex.: 3). Default is 4
+        Returns: URL of page with storage health
         """
-        version_lookup = self._soup.find('div', id='logo_writing')
-        if version_lookup:
-            if 'SANOS 4.0' not in version_lookup.text:
-                self._SANOS_VERSION = 3
-        else:
-            self._SANOS_VERSION = 3
+        if self._SANOS_VERSION == 4:
+            return self._url + self._url_path_health
 
-    def is_storage_health_Good(self):
+        # SANOS3 Support
+        return self._url + self._url_path_health_SANOS3
+
+    def _parse_health(self, soup):
         """
-        Method for getting storage health status
         Returns: True if Good, False if storage is in Degraded state or None
         if unable to check state
         """
         if self._SANOS_VERSION == 4:
-            self._connection(self._url + self._url_path_health,
-                             username=None,
-                             password=None,
-                             data=None)
-
-            for item in self._soup.response.data.find_all('system'):
+            for item in soup.response.data.find_all('system'):
                 if item.item.text == 'System Health':
                     if item.value.text == "Good":
                         return True
@@ -263,12 +365,7 @@ class QSAN():
 
         elif self._SANOS_VERSION == 3:
             # SANOS3 Support
-            self._connection(self._url + self._url_path_health_SANOS3,
-                             username=None,
-                             password=None,
-                             data=None)
-
-            status_div = self._soup.find('div', id='status_led')
+            status_div = soup.find('div', id='status_led')
             for el in status_div.find_all('input'):
                 if '-green.gif' not in el['src']:
                     return False
@@ -276,6 +373,43 @@ class QSAN():
             if status_div:
                 return True
 
+    def _detect_capabilities(self):
+        """
+        Filling self._capabilities with results of discovery
+        """
+        self._capabilities.update({
+            'sanos_version': self._SANOS_VERSION,
+            'fc': bool(self._FCs),
+            # Have no information about Cache Pools support in SANOS3
+            'cache_pools': self._SANOS_VERSION == 4 and bool(self._CPs),
+            # SANOS3-based storages doesn't support storage stats
+            'storage_stats': self._SANOS_VERSION == 4
+        })
+
+    def _discovery_data(self):
+        """
+        Returns: discovered objects and capabilities for DiscoveryCache
+        """
+        return {
+            'capabilities': self._capabilities,
+            'VDs': self._VDs,
+            'DISKs': self._DISKs,
+            'CPs': self._CPs,
+            'FCs': self._FCs
+        }
+
+    def _restore_discovery(self, data):
+        """
+        Restoring discovered objects and capabilities got by
+        _discovery_data()
+        """
+        self._capabilities.update(data['capabilities'])
+        self._SANOS_VERSION = self._capabilities['sanos_version']
+        self._VDs = data['VDs']
+        self._DISKs = data['DISKs']
+        self._CPs = data['CPs']
+        self._FCs = data['FCs']
+
     def _get_VD_name_by_id(self, id):
         """
         Forms name of VD by givend VD id. No spaces allowed
@@ -292,78 +426,57 @@ class QSAN():
 
         return '_'.join([name, raid, capacity])
 
-    def vd_discovery(self):
+    def _parse_vd_page(self, soup):
         """
-        Getting Volumes information from Storage
-        Fills self._VDs with:
-        {'id': {'name': '', 'capacity': '', 'raid': '', ... },
-         'id': {'name': '', 'capacity': '', 'raid': '', ... }, ... }
+        Parsing one page of Volumes list
+        Returns: (VDs count, {'id': {'name': '', 'capacity': '', ... }, ... },
+                  True if next page should be requested)
         """
-        page = 1
         VDs = {}
+        next_page = False
 
-        while True:
-            # Iteration over pages
-            params = '&page=' + str(page)
-
-            self._connection(self._url + self._url_path_VD + params,
-                             username=None,
-                             password=None,
-                             data=None)
-
-            VD_count = int(self._soup.response.find('vd_num').text)
-
-            # Iteration over VDs
-            for udv in self._soup.response.find_all('udv'):
-                if udv:
-                    attrs = {}
-                    for attr in udv:
-                        if attr.name:
-                            attrs[attr.name] = attr.text
+        VD_count = int(soup.response.find('vd_num').text)
 
-                    attrs.pop('id', None)
+        # Iteration over VDs
+        for udv in soup.response.find_all('udv'):
+            if udv:
+                attrs = {}
+                for attr in udv:
+                    if attr.name:
+                        attrs[attr.name] = attr.text
 
-                    vd = {udv.find('id').text: attrs}
-                    VDs.update(vd)
-                else:
-                    page += 1
+                attrs.pop('id', None)
 
-            if len(VDs) == VD_count:
-                break
+                vd = {udv.find('id').text: attrs}
+                VDs.update(vd)
+            else:
+                next_page = True
 
-        self._VDs = VDs
+        return VD_count, VDs, next_page
 
-    def _vd_stats_enable_VDs(self, VDs):
+    def _vd_stats_enable_url(self, VDs):
         """
-        Enables monitoring for specified VDs
+        Returns: URL enabling monitoring for specified VDs
         """
         p = '&volume_arr=' + ','.join([vd for vd in VDs])
 
-        self._connection(self._url + self._url_path_select_stats_VD + p,
-                         username=None,
-                         password=None,
-                         post=True,
-                         data=None)
+        return self._url + self._url_path_select_stats_VD + p
 
-    def vd_stats(self):
+    def _parse_vd_stats(self, soup):
         """
-        Getting Volumes stats
-        Returns: {'id': {'iops': 123, 'read': 123, 'write': 123}}
+        Returns: ({'id': {'iops': 123, 'read': 123, 'write': 123}},
+                  [ids of monitored VDs])
         """
         VDstats = {}
-
-        volumes_IDs = [volume for volume in self._VDs]
         volumes_monitoring_check = []
 
-        self._connection(self._url + self._url_path_VD_stats,
-                         username=None,
-                         password=None,
-                         data=None)
-
         # Iteration over VDs
-        for volume_stats in self._soup.response.find_all('volume_stats'):
+        for volume_stats in soup.response.find_all('volume_stats'):
             if volume_stats.vd_id:
                 vid = volume_stats.find('vd_id').text
+                if vid not in self._VDs:
+                    # Created after discovery
+                    continue
                 stats = {
                     vid: {
                         'iops': volume_stats.find('iops_rate').text,
@@ -379,29 +492,17 @@ class QSAN():
 
                 VDstats.update(stats)
 
-        # Enabling monitoring of unmonitored VDs
-        if set(volumes_monitoring_check) != set(volumes_IDs):
-            self._vd_stats_enable_VDs(volumes_IDs)
-
-        return VDstats
+        return VDstats, volumes_monitoring_check
 
-    def disk_discovery(self):
+    def _parse_disks(self, soup):
         """
-        Getting Disk information from Storage
-        Fills self._DISKs with:
-        {'id': {'slot': '', 'size': '', 'vendor': '', ... },
-         'id': {'slot': '', 'size': '', 'vendor': '', ... }, ... }
+        Returns: {'id': {'slot': '', 'size': '', 'vendor': '', ... },
+                  'id': {'slot': '', 'size': '', 'vendor': '', ... }, ... }
         """
-
         DISKs = {}
 
-        self._connection(self._url + self._url_path_DISK,
-                         username=None,
-                         password=None,
-                         data=None)
-
         # Iteration over DISKs
-        for hdd in self._soup.response.find_all('hdd'):
+        for hdd in soup.response.find_all('hdd'):
             if hdd:
                 attrs = {}
                 for attr in hdd:
@@ -413,11 +514,11 @@ class QSAN():
                 d = {hdd.find('id').text: attrs}
                 DISKs.update(d)
 
-        self._DISKs = DISKs
+        return DISKs
 
-    def _disk_stats_enable_DISKs(self, DISKs):
+    def _disk_stats_enable_url(self, DISKs):
         """
-        Enables monitoring for specified DISKs
+        Returns: URL enabling monitoring for specified DISKs
         """
         slots = []
         for disk in DISKs:
@@ -426,32 +527,24 @@ class QSAN():
 
         p = '&slot_arr=' + ','.join([slot for slot in slots])
 
-        self._connection(self._url + self._url_path_select_stats_DISK + p,
-                         username=None,
-                         password=None,
-                         post=True,
-                         data=None)
+        return self._url + self._url_path_select_stats_DISK + p
 
-    def disk_stats(self):
+    def _parse_disk_stats(self, soup):
         """
-        Getting Disks stats
-        Returns: {id: {'latency': '123', 'thruput': '123'}}
+        Returns: ({id: {'latency': '123', 'thruput': '123'}},
+                  [ids of monitored DISKs])
         """
         DISKstats = {}
-
-        disks_IDs = [disk for disk in self._DISKs]
         disks_monitoring_check = []
 
-        self._connection(self._url + self._url_path_DISK_stats,
-                         username=None,
-                         password=None,
-                         data=None)
-
         # Iteration over DISKs
-        for disk_stats in self._soup.response.find_all('disk_monitor_stats'):
+        for disk_stats in soup.response.find_all('disk_monitor_stats'):
             if disk_stats.slot:
                 slot = disk_stats.find('slot').text
                 id = self._get_DISK_id_by_slot(slot)
+                if id is None:
+                    # Inserted after discovery
+                    continue
 
                 # Checking wether disk monitoring enabled or not
                 if disk_stats.find('is_enabled').text == 'Yes':
@@ -469,11 +562,7 @@ class QSAN():
 
                 DISKstats.update(stats)
 
-        # Enabling monitoring of unmonitored DISKs
-        if set(disks_monitoring_check) != set(disks_IDs):
-            self._disk_stats_enable_DISKs(disks_IDs)
-
-        return DISKstats
+        return DISKstats, disks_monitoring_check
 
     def _get_DISK_id_by_slot(self, slot):
         """
@@ -512,26 +601,16 @@ class QSAN():
 
         return disk
 
-    def cache_pool_discovery(self):
+    def _parse_cps(self, soup):
         """
-        Getting Cache Pools (CPs) information from Storage
-        Fills self._CPs with:
-        {'Name': {'rg_id': '', 'rg_name': '', 'ssd_name': '', ... },
-         'Name': {'rg_id': '', 'rg_name': '', 'ssd_name': '', ... }, ... }
+        Returns: {'Name': {'rg_id': '', 'rg_name': '', 'ssd_name': '', ... },
+                  'Name': {'rg_id': '', 'rg_name': '', 'ssd_name': '', ... },
+                  ... }
         """
-        if self._SANOS_VERSION == 3:
-            # Have no information about Cache Pools support in SANOS3
-            return {}
-
         CPs = {}
 
-        self._connection(self._url + self._url_path_CP,
-                         username=None,
-                         password=None,
-                         data=None)
-
         # Iteration over Cache Pools
-        for cp in self._soup.response.find_all('ssdpoollist'):
+        for cp in soup.response.find_all('ssdpoollist'):
             if cp:
                 attrs = {}
                 for attr in cp:
@@ -541,12 +620,10 @@ class QSAN():
                 c = {cp.find('ssd_name').text.replace(' ', '-'): attrs}
                 CPs.update(c)
 
-        self._CPs = CPs
+        return CPs
 
-    def cp_stats(self):
+    def _parse_cp_stats(self, soup):
         """
-        Getting Cache Pool stats (separate stats for each
-        ssd-enabled vd in pool)
         Returns: {'id': {'rg_id': '', 'name': '',
                          'rg_name': '', ..., 'stats': {'vd': {'p1': '',
                                                               'p2': '',
@@ -556,20 +633,11 @@ class QSAN():
                                                               'pn': '', ... }}
                                                        ... }}
         """
-        if self._SANOS_VERSION == 3:
-            # Have no information about Cache Pools support in SANOS3
-            return {}
-
         Pools = {}
         Volume_Groups = {}
 
-        self._connection(self._url + self._url_path_CP_stats,
-                         username=None,
-                         password=None,
-                         data=None)
-
         # Pools
-        for p in self._soup.response.find_all('pool_data'):
+        for p in soup.response.find_all('pool_data'):
             if p.name:
                 pool_id = p.find('rg_id').text
 
@@ -582,7 +650,7 @@ class QSAN():
                 Pools.update(pool)
 
         # Volume Groups
-        for vg in self._soup.response.find_all('vol_data'):
+        for vg in soup.response.find_all('vol_data'):
             if vg.name:
                 vol_id = vg.find('vd').text
 
@@ -608,10 +676,9 @@ class QSAN():
 
         return Pools
 
-    def cp_stats_summarize(self):
+    def _cp_stats_summarize(self, cp_stats):
         """
-        Getting some of Cache Pool stats in summary by Volumes as
-        one cache pool can serve more than one Volume in Raid/Volume group
+        Summarizing cp_stats() by Volumes
         Returns: {'cachepoolname': {'log_rd_hit': '',
                                     'log_rd_tot': '',
                                     'size_alloc': '',
@@ -619,7 +686,6 @@ class QSAN():
                                     'size_dirty': '',
                                     'ratio': ''}}
         """
-        cp_stats = self.cp_stats()
         stats = {}
 
         for cp_params in cp_stats.values():
@@ -649,94 +715,87 @@ class QSAN():
 
         return stats
 
-    def fc_discovery(self):
+    def _parse_fcs(self, soup, controller):
         """
-        Getting FC Ports information from Storage
-        Fills self._FCs with:
+        Returns: FC ports of given controller:
         {'slot:port': {'name': '', 'status': '', 'data_rate': '', ... },
          'slot:port': {'name': '', 'status': '', 'data_rate': '', ... }, ... }
         """
         FCs = {}
 
-        # Iteration over Controllers
-        for controller in ['0', '1']:
-            self._connection(self._url + self._url_path_FC + controller,
-                             username=None,
-                             password=None,
-                             data=None)
+        # If Storage has Fibre Channel ports
+        if soup.response:
+            # Iteration over ports
+            for fcp in soup.response.find_all('fc_port_value'):
+                if fcp:
+                    attrs = {}
+                    for attr in fcp:
+                        if attr.name:
+                            attrs[attr.name] = attr.text
 
-            # If Storage has Fibre Channel ports
-            if self._soup.response:
-                # Iteration over ports
-                for fcp in self._soup.response.find_all('fc_port_value'):
-                    if fcp:
-                        attrs = {}
-                        for attr in fcp:
-                            if attr.name:
-                                attrs[attr.name] = attr.text
-
-                        # SANOS3 support
-                        if self._SANOS_VERSION == 3:
-                            port_id = str(int(attrs.get('name')[5:6]) - 1)
-                        else:
-                            port_id = str(int(attrs.get('name')[2:3]) - 1)
+                    # SANOS3 support
+                    if self._SANOS_VERSION == 3:
+                        port_id = str(int(attrs.get('name')[5:6]) - 1)
+                    else:
+                        port_id = str(int(attrs.get('name')[2:3]) - 1)
 
-                        p = {':'.join([controller, port_id]): attrs}
+                    p = {':'.join([controller, port_id]): attrs}
 
-                        FCs.update(p)
+                    FCs.update(p)
 
-        self._FCs = FCs
+        return FCs
 
-    def _fc_stats_enable_FCs(self, FCs):
+    def _fc_stats_enable_requests(self, FCs):
         """
-        Enables monitoring for specified FC ports
+        Returns: [(url, data), ... ] of requests enabling monitoring for
+        specified FC ports
         """
         FCs.sort()
 
         if self._SANOS_VERSION == 4:
             p = '&fibre_arr=' + ','.join([fc for fc in FCs])
 
-            self._connection(self._url + self._url_path_select_stats_FC + p,
-                             username=None,
-                             password=None,
-                             post=True,
-                             data=None)
-        else:
-            # SANOS 3
+            return [(self._url + self._url_path_select_stats_FC + p, None)]
+
+        # SANOS 3
+        reqs = []
+        for slotport in FCs:
             PARAMS = {
-                'ctrl_idx': None,
+                'ctrl_idx': slotport[0:1],
                 'is_enable': 1,
                 'op': 'fcport_set_monitor',
-                'port_idx': None
+                'port_idx': slotport[2:3]
                 }
-            for slotport in FCs:
-                PARAMS['ctrl_idx'] = slotport[0:1]
-                PARAMS['port_idx'] = slotport[2:3]
+            reqs.append((self._url + self._url_path_select_stats_FC_SANOS3,
+                         PARAMS))
 
-                self._connection(self._url +
-                                 self._url_path_select_stats_FC_SANOS3,
-                                 username=None,
-                                 password=None,
-                                 post=True,
-                                 data=PARAMS)
+        return reqs
 
-    def fc_stats(self):
+    def _fc_stats_to_enable(self, ports_IDs, ports_monitoring_check):
         """
-        Getting FC ports stats
-        Returns: {'slot:port': {'tx': '123', 'rx': '123'}}
+        Returns: list of FC ports which monitoring should be enabled for
         """
-        FCstats = {}
+        # Enabling monitoring of unmonitored FCs
+        if set(ports_monitoring_check) != set(ports_IDs):
+            if self._SANOS_VERSION == 4:
+                return list(ports_IDs)
+            else:
+                # SANOS3
+                diff = set(ports_IDs) - set(ports_monitoring_check)
+                return list(diff)
 
-        ports_IDs = [port for port in self._FCs]
-        ports_monitoring_check = []
+        return []
 
-        self._connection(self._url + self._url_path_FC_stats,
-                         username=None,
-                         password=None,
-                         data=None)
+    def _parse_fc_stats(self, soup):
+        """
+        Returns: ({'slot:port': {'tx': '123', 'rx': '123'}},
+                  [ids of monitored ports])
+        """
+        FCstats = {}
+        ports_monitoring_check = []
 
         # Iteration over Controllers
-        for ctrl_fcport in self._soup.response.find_all('ctrl_fcport_info'):
+        for ctrl_fcport in soup.response.find_all('ctrl_fcport_info'):
             if ctrl_fcport:
                 controller = ctrl_fcport.find('ctrl_idx').text
 
@@ -745,6 +804,8 @@ class QSAN():
                     if fcport_stats:
                         port = fcport_stats.find('port_idx').text
                         id = controller + ':' + port
+                        if id not in self._FCs:
+                            continue
 
                         # Checking wether port monitoring enabled or not
                         if fcport_stats.find('is_enabled').text == 'Yes':
@@ -771,16 +832,7 @@ class QSAN():
 
                         FCstats.update(stats)
 
-        # Enabling monitoring of unmonitored FCs
-        if set(ports_monitoring_check) != set(ports_IDs):
-            if self._SANOS_VERSION == 4:
-                self._fc_stats_enable_FCs(ports_IDs)
-            else:
-                # SANOS3
-                diff = set(ports_IDs) - set(ports_monitoring_check)
-                self._fc_stats_enable_FCs(list(diff))
-
-        return FCstats
+        return FCstats, ports_monitoring_check
 
     def _get_FC_port_name_by_id(self, port):
         """
@@ -795,73 +847,861 @@ class QSAN():
 
         return fcport
 
+    def _snapshot(self, clock, storage, VDstats, DISKstats, FCstats,
+                  CPstats):
+        """
+        Returns: Snapshot of discovered objects and given stats
+        """
+        def items(inventory, stats, name):
+            return _frozendict(dict(
+                (id, SnapshotItem(id, name(id), _frozendict(dict(attrs)),
+                                  _frozendict(dict(stats.get(id, {})))))
+                for id, attrs in inventory.items()
+            ))
+
+        return Snapshot(
+            host=self._host,
+            clock=clock,
+            sanos_version=self._SANOS_VERSION,
+            storage=_frozendict(dict(storage)),
+            volumes=items(self._VDs, VDstats, self._get_VD_name_by_id),
+            disks=items(self._DISKs, DISKstats, self._get_DISK_name_by_id),
+            fc_ports=items(self._FCs, FCstats, self._get_FC_port_name_by_id),
+            cache_pools=items(self._CPs, CPstats, lambda cp: cp)
+        )
 
-class Zabbix():
+
+class QSAN(BaseQSAN):
     """
-    Class for operationing with zabbix
+    Class for operationing with qsan
     """
-    _DATA = {'data': []}
 
-    def __init__(self, qsan):
+    def __init__(self, host=None, username='user', password='1234',
+                 recorder=None, adapter=None, cache=None):
         """
+        Connecting to QSAN storage. Makinkg discovery of Volumes and Disks.
+        recorder (Recorder) gets all responses, adapter (requests transport
+        adapter, ex.: ReplayAdapter) replaces HTTP transport, discovery is
+        taken from cache (DiscoveryCache) while it's fresh
         """
-        self._qsan = qsan
+        BaseQSAN.__init__(self, host, username, password)
+        self._recorder = recorder
+        self._adapter = adapter
+        self._session = None
+        self._data = None
+        self._soup = None
+        self.connect()
+
+        if cache and cache.load(self):
+            return
+
+        self._sanos_version_detect()
+        self.vd_discovery()
+        self.disk_discovery()
+        self.cache_pool_discovery()
+        self.fc_discovery()
+        self._detect_capabilities()
+        self._discovery_fetched = True
+
+        if cache:
+            cache.save(self)
+
+    def _is_request_ok(self, r):
+        """
+        Checking HTTP respose status
+        Returns: bool
+        """
+
+        return (r.ok or r.status_code == 200 or r.status_code == 302)
+
+    def _connection_init(self):
+        """
+        Closing session and establishing new one
+        """
+        if self._session:
+            self._session.close()
+
+        self._session = requests.Session()
+
+        if self._adapter:
+            self._session.mount('http://', self._adapter)
+
+        if self._recorder:
+            self._session.hooks['response'].append(self._recorder.record)
+
+    def _connection(self, url, post=False, data=None):
+        """
+        Main connection method
+        Returns: session object if got succesfull HTTP response
+        with _is_request_ok()
+        """
+        try:
+            if post:
+                r = self._session.post(url,
+                                       headers=self._HEADERS,
+                                       timeout=self._connection_timeout,
+                                       data=data)
+            else:
+                r = self._session.get(url,
+                                      headers=self._HEADERS,
+                                      timeout=self._connection_timeout,
+                                      data=data)
+
+            self._soup = self._bs4(r.text)
+
+            if not self._is_request_ok(r):
+                raise RequestException('Something wrong with request')
+
+            return r
+        except (RequestException, ConnectionError, ConnectTimeout,
+                SSLError, MissingSchema, RetryError, ProxyError,
+                InvalidHeader, ReadTimeout, UnrewindableBodyError,
+                ChunkedEncodingError, HTTPError, StreamConsumedError,
+                Timeout, TooManyRedirects, ContentDecodingError) as e:
+
+            raise RequestException('Error making request: ' + str(e))
+
+    def _authorize(self):
+        """
+        Authorizing at QSAN management web-interface
+        Returns: bool with _is_authorized()
+        """
+        self._connection(self._url + self._url_path_login,
+                         post=True,
+                         data=self._login_keys())
+
+        return self._is_authorized(self._soup)
+
+    def connect(self):
+        """
+        Common connect method
+        """
+        self._connection_init()
+
+        if not self._authorize():
+            raise RequestException('Unable to authorize!')
+
+    def storage_stats(self):
+        """
+        Getting stats from dashboard
+        Returns: {'iops': '10764', 'read': '282640625', 'write': '1255703125'}
+        """
+        if not self._capabilities['storage_stats']:
+            return {}
+
+        self._connection(self._url + self._url_path_data,
+                         data=None)
+
+        return self._parse_storage_stats(self._soup)
+
+    def _sanos_version_detect(self):
+        """
+        Detecting SANOS Version
+        Sets self._SANOS_VERSION with int(major_version, ex.: 3). Default is 4
+        """
+        self._SANOS_VERSION = self._parse_sanos_version(self._soup)
+
+    def is_storage_health_Good(self):
+        """
+        Method for getting storage health status
+        Returns: True if Good, False if storage is in Degraded state or None
+        if unable to check state
+        """
+        self._connection(self._health_url(),
+                         data=None)
+
+        return self._parse_health(self._soup)
+
+    def vd_discovery(self):
+        """
+        Getting Volumes information from Storage
+        Fills self._VDs with:
+        {'id': {'name': '', 'capacity': '', 'raid': '', ... },
+         'id': {'name': '', 'capacity': '', 'raid': '', ... }, ... }
+        """
+        page = 1
+        VDs = {}
+
+        while True:
+            # Iteration over pages
+            params = '&page=' + str(page)
+
+            self._connection(self._url + self._url_path_VD + params,
+                             data=None)
+
+            VD_count, page_VDs, next_page = self._parse_vd_page(self._soup)
+            VDs.update(page_VDs)
+            if next_page:
+                page += 1
+
+            if len(VDs) == VD_count:
+                break
+
+        self._VDs = VDs
+
+    def inventory_refresh(self):
+        """
+        Getting current status of Volumes, Disks and FC ports if discovery
+        was taken from cache. Controllers which don't answer this time are
+        kept in detected capabilities
+        """
+        controllers = self._capabilities['controllers']
+
+        self.vd_discovery()
+        self.disk_discovery()
+        if self._capabilities['fc']:
+            self.fc_discovery()
+            self._capabilities['controllers'] = controllers
+
+        self._discovery_fetched = True
+
+    def _vd_stats_enable_VDs(self, VDs):
+        """
+        Enables monitoring for specified VDs
+        """
+        self._connection(self._vd_stats_enable_url(VDs),
+                         post=True,
+                         data=None)
+
+    def vd_stats(self):
+        """
+        Getting Volumes stats
+        Returns: {'id': {'iops': 123, 'read': 123, 'write': 123}}
+        """
+        volumes_IDs = [volume for volume in self._VDs]
+
+        self._connection(self._url + self._url_path_VD_stats,
+                         data=None)
+
+        VDstats, volumes_monitoring_check = self._parse_vd_stats(self._soup)
+
+        # Enabling monitoring of unmonitored VDs
+        if set(volumes_monitoring_check) != set(volumes_IDs):
+            self._vd_stats_enable_VDs(volumes_IDs)
+
+        return VDstats
+
+    def disk_discovery(self):
+        """
+        Getting Disk information from Storage
+        Fills self._DISKs with:
+        {'id': {'slot': '', 'size': '', 'vendor': '', ... },
+         'id': {'slot': '', 'size': '', 'vendor': '', ... }, ... }
+        """
+        self._connection(self._url + self._url_path_DISK,
+                         data=None)
+
+        self._DISKs = self._parse_disks(self._soup)
+
+    def _disk_stats_enable_DISKs(self, DISKs):
+        """
+        Enables monitoring for specified DISKs
+        """
+        self._connection(self._disk_stats_enable_url(DISKs),
+                         post=True,
+                         data=None)
+
+    def disk_stats(self):
+        """
+        Getting Disks stats
+        Returns: {id: {'latency': '123', 'thruput': '123'}}
+        """
+        disks_IDs = [disk for disk in self._DISKs]
+
+        self._connection(self._url + self._url_path_DISK_stats,
+                         data=None)
+
+        DISKstats, disks_monitoring_check = self._parse_disk_stats(self._soup)
+
+        # Enabling monitoring of unmonitored DISKs
+        if set(disks_monitoring_check) != set(disks_IDs):
+            self._disk_stats_enable_DISKs(disks_IDs)
+
+        return DISKstats
+
+    def cache_pool_discovery(self):
+        """
+        Getting Cache Pools (CPs) information from Storage
+        Fills self._CPs with:
+        {'Name': {'rg_id': '', 'rg_name': '', 'ssd_name': '', ... },
+         'Name': {'rg_id': '', 'rg_name': '', 'ssd_name': '', ... }, ... }
+        """
+        if self._SANOS_VERSION == 3:
+            # Have no information about Cache Pools support in SANOS3
+            return {}
+
+        self._connection(self._url + self._url_path_CP,
+                         data=None)
+
+        self._CPs = self._parse_cps(self._soup)
+
+    def cp_stats(self):
+        """
+        Getting Cache Pool stats (separate stats for each
+        ssd-enabled vd in pool)
+        Returns: {'id': {'rg_id': '', 'name': '',
+                         'rg_name': '', ..., 'stats': {'vd': {'p1': '',
+                                                              'p2': '',
+                                                              'pn': '', ... }},
+                                                      {'vd': {'p1': '',
+                                                              'p2': '',
+                                                              'pn': '', ... }}
+                                                       ... }}
+        """
+        if not self._capabilities['cache_pools']:
+            return {}
+
+        self._connection(self._url + self._url_path_CP_stats,
+                         data=None)
+
+        return self._parse_cp_stats(self._soup)
+
+    def cp_stats_summarize(self):
+        """
+        Getting some of Cache Pool stats in summary by Volumes as
+        one cache pool can serve more than one Volume in Raid/Volume group
+        Returns: {'cachepoolname': {'log_rd_hit': '',
+                                    'log_rd_tot': '',
+                                    'size_alloc': '',
+                                    'size_cached': '',
+                                    'size_dirty': '',
+                                    'ratio': ''}}
+        """
+        return self._cp_stats_summarize(self.cp_stats())
+
+    def fc_discovery(self):
+        """
+        Getting FC Ports information from Storage
+        Fills self._FCs with:
+        {'slot:port': {'name': '', 'status': '', 'data_rate': '', ... },
+         'slot:port': {'name': '', 'status': '', 'data_rate': '', ... }, ... }
+        """
+        FCs = {}
+        controllers = []
+
+        # Iteration over Controllers
+        for controller in self._capabilities['controllers']:
+            self._connection(self._url + self._url_path_FC + controller,
+                             data=None)
+
+            if self._soup.response:
+                controllers.append(controller)
+            FCs.update(self._parse_fcs(self._soup, controller))
+
+        self._FCs = FCs
+        self._capabilities['controllers'] = controllers
+
+    def _fc_stats_enable_FCs(self, FCs):
+        """
+        Enables monitoring for specified FC ports
+        """
+        for url, data in self._fc_stats_enable_requests(FCs):
+            self._connection(url,
+                             post=True,
+                             data=data)
+
+    def fc_stats(self):
+        """
+        Getting FC ports stats
+        Returns: {'slot:port': {'tx': '123', 'rx': '123'}}
+        """
+        if not self._capabilities['fc']:
+            return {}
+
+        ports_IDs = [port for port in self._FCs]
+
+        self._connection(self._url + self._url_path_FC_stats,
+                         data=None)
+
+        FCstats, ports_monitoring_check = self._parse_fc_stats(self._soup)
+
+        FCs = self._fc_stats_to_enable(ports_IDs, ports_monitoring_check)
+        if FCs:
+            self._fc_stats_enable_FCs(FCs)
+
+        return FCstats
+
+    def snapshot(self):
+        """
+        Getting inventory and all stats in one collection pass
+        Returns: Snapshot with read-only mappings
+        """
+        clock = int(time.time())
+
+        return self._snapshot(clock,
+                              self.storage_stats(),
+                              self.vd_stats(),
+                              self.disk_stats(),
+                              self.fc_stats(),
+                              self.cp_stats_summarize())
+
+
+def _capture_key(request):
+    """
+    Returns: (method, path with query, body) of request with password
+    removed from body
+    """
+    url = urlsplit(request.url)
+    path = url.path + ('?' + url.query if url.query else '')
+
+    body = request.body or ''
+    if isinstance(body, bytes):
+        body = body.decode('utf8')
+
+    params = parse_qsl(body, keep_blank_values=True)
+    if any(param == 'password' for param, value in params):
+        body = urlencode([(param, '' if param == 'password' else value)
+                          for param, value in params])
+
+    return request.method, path, body
+
+
+class Recorder():
+    """
+    Recording of all requests and responses of QSAN to DIR/host.jsonl.gz.
+    Every run appends to the file, see ReplayAdapter
+    """
+
+    def __init__(self, path, host):
+        """
+        """
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._file = gzip.open(os.path.join(path, host + '.jsonl.gz'), 'ab')
+
+    def record(self, r, *args, **kwargs):
+        """
+        requests response hook
+        Writes: {"method": "GET", "path": "/vd_x.php?...", "body": "",
+                 "status": 200, "reason": "OK", "headers": {...},
+                 "text": "<response>...", "elapsed": 0.012,
+                 "clock": 1556618477.1}
+        """
+        method, path, body = _capture_key(r.request)
+
+        record = {
+            'method': method,
+            'path': path,
+            'body': body,
+            'status': r.status_code,
+            'reason': r.reason,
+            'headers': dict(r.headers),
+            'text': r.text,
+            'elapsed': r.elapsed.total_seconds(),
+            'clock': time.time()
+        }
+
+        self._file.write((json.dumps(record) + '\n').encode('utf8'))
+
+        return r
+
+    def close(self):
+        """
+        Closing archive
+        """
+        self._file.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    requests transport adapter serving responses recorded by Recorder.
+    Responses to the same request are served in recorded order, the last
+    one is served again when they are over
+    """
+
+    # Headers describing original encoding of body
+    _SKIP_HEADERS = ['content-encoding', 'content-length',
+                     'transfer-encoding']
+
+    def __init__(self, path, host, latency=True):
+        """
+        latency - delay responses by recorded response time
+        """
+        BaseAdapter.__init__(self)
+        self._latency = latency
+        self._records = {}
+        self._served = {}
+
+        with gzip.open(os.path.join(path, host + '.jsonl.gz'), 'rb') as f:
+            for line in f:
+                record = json.loads(line.decode('utf8'))
+                key = (record['method'], record['path'], record['body'])
+                self._records.setdefault(key, []).append(record)
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        """
+        Returns: recorded requests.Response for request
+        """
+        key = _capture_key(request)
+        records = self._records.get(key)
+        if not records:
+            raise ConnectionError('No recorded response for ' +
+                                  ' '.join(key[:2]))
+
+        served = self._served.get(key, 0)
+        self._served[key] = served + 1
+        record = records[min(served, len(records) - 1)]
+
+        if self._latency:
+            time.sleep(record['elapsed'])
+
+        r = requests.Response()
+        r.status_code = record['status']
+        r.reason = record['reason']
+        r.headers = CaseInsensitiveDict(
+            (k, v) for k, v in record['headers'].items()
+            if k.lower() not in self._SKIP_HEADERS)
+        r._content = record['text'].encode('utf8')
+        r.encoding = 'utf8'
+        r.url = request.url
+        r.request = request
+        r.elapsed = datetime.timedelta(seconds=record['elapsed'])
+
+        return r
+
+    def close(self):
+        """
+        """
+        pass
+
+
+class DiscoveryCache():
+    """
+    Per storage cache of discovered objects and capabilities in
+    DIR/host.json. Lets stats methods skip discovery requests and requests
+    which can only return nothing
+    """
+
+    def __init__(self, path, host, ttl=3600, refresh=False):
+        """
+        refresh ignores cached discovery but it's still saved
+        """
+        self._file = os.path.join(path, host.replace(os.sep, '_') + '.json')
+        self._ttl = ttl
+        self._refresh = refresh
+        self._disabled = False
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                self._disable(e)
+
+    def _disable(self, e):
+        """
+        Turning cache off with one warning. Cache only saves requests, so
+        its errors must not stop collection
+        """
+        if not self._disabled:
+            sys.stderr.write('Discovery cache is disabled: %s\n' % e)
+
+        self._disabled = True
+
+    def _read(self):
+        """
+        Returns: saved discovery or None
+        """
+        try:
+            with open(self._file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, data):
+        """
+        Atomically writing discovery
+        """
+        tmp = self._file + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+
+        os.rename(tmp, self._file)
+
+    def load(self, qsan):
+        """
+        Restoring discovery of qsan if cache is fresh. Capabilities of
+        stale cache are not restored, so discovery probes all controllers
+        again and finds ones which didn't answer last time
+        Returns: True if qsan doesn't need discovery
+        """
+        if self._refresh or self._disabled:
+            return False
+
+        data = self._read()
+        if not data or time.time() - data.get('clock', 0) >= self._ttl:
+            return False
+
+        qsan._restore_discovery(data)
+
+        return True
+
+    def save(self, qsan):
+        """
+        Saving discovery of qsan
+        """
+        if self._disabled:
+            return
+
+        data = qsan._discovery_data()
+        data['clock'] = int(time.time())
+
+        try:
+            self._write(data)
+        except (IOError, OSError) as e:
+            self._disable(e)
+
+
+class DiscoveryState():
+    """
+    Hashes of discovery sent to Zabbix host in DIR/zhost.lld.json. Zabbix
+    processes every received discovery value for all prototypes, so
+    discovery is sent only if set of discovered objects changed or
+    heartbeat seconds passed
+    """
+
+    def __init__(self, path, zhost, heartbeat=86400):
+        """
+        """
+        self._file = os.path.join(path,
+                                  zhost.replace(os.sep, '_') + '.lld.json')
+        self._heartbeat = heartbeat
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        try:
+            with open(self._file) as f:
+                self._state = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._state = {}
+
+    def _hash(self, data):
+        """
+        Returns: hash of discovery not depending on objects order
+        """
+        rows = sorted(json.dumps(row, sort_keys=True)
+                      for row in data['data'])
+
+        return hashlib.sha1('\n'.join(rows).encode('utf8')).hexdigest()
+
+    def changed(self, key, data):
+        """
+        Returns: True if discovery of key should be sent
+        """
+        sent = self._state.get(key)
+        if not sent or sent['hash'] != self._hash(data):
+            return True
+
+        return time.time() - sent['clock'] >= self._heartbeat
+
+    def sent(self, key, data):
+        """
+        Remembering discovery of key as sent
+        """
+        self._state[key] = {'hash': self._hash(data),
+                            'clock': int(time.time())}
+
+    def save(self):
+        """
+        Atomically writing state. Unsaved discovery is just sent again
+        """
+        tmp = self._file + '.%d.tmp' % os.getpid()
+
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._state, f)
+
+            os.rename(tmp, self._file)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Unable to save discovery state: %s\n' % e)
+
+
+class Zabbix():
+    """
+    Class for operationing with zabbix
+    """
+
+    def __init__(self, qsan, sender=None):
+        """
+        Stats are printed to stdout or passed to sender (ZabbixSender)
+        if given
+        """
+        self._qsan = qsan
+        self._sender = sender
+
+    def _print_item(self, zhost, key, value):
+        """
+        Returns:
+        zhost	key	value
+        """
+        if self._sender is not None:
+            self._sender.add('\t'.join([zhost, key, value]))
+        else:
+            print('\t'.join([zhost, key, _zabbix_value(value)]))
+
+    def print_storage_stats(self, zhost):
+        """
+        Returns:
+        zhost	qsan.sanos4.storage.iops	123
+        zhost	qsan.sanos4.storage.read	123
+        zhost	qsan.sanos4.storage.write	123
+        """
+        for param, value in self._qsan.storage_stats().items():
+            self._print_item(zhost, 'qsan.sanos4.storage.' + param, value)
+
+    def print_storage_health(self, zhost):
+        """
+        Returns:
+        zhost	qsan.sanos4.storage.health	1
+        """
+        try:
+            health = self._qsan.is_storage_health_Good()
+        except (RequestException, AttributeError):
+            # Health page is missing or has unexpected layout
+            return
+
+        if health is not None:
+            self._print_item(zhost, 'qsan.sanos4.storage.health',
+                             '1' if health else '0')
+
+    def print_inventory(self, zhost):
+        """
+        Attributes got by discovery, no requests are made
+        Returns:
+        zhost	qsan.sanos4.volume.status[volname]	Online
+        zhost	qsan.sanos4.disk.health[diskname]	Good
+        zhost	qsan.sanos4.fcport.data_rate[portname]	16Gb
+        ...
+        """
+        for kind, objects, name, attrs in _INVENTORY_ITEMS:
+            for id, inventory in getattr(self._qsan, objects).items():
+                n = getattr(self._qsan, name)(id)
+
+                for attr in attrs:
+                    if attr in inventory:
+                        self._print_item(zhost,
+                                         'qsan.sanos4.' + kind + '.' +
+                                         attr + '[' + n + ']',
+                                         ' '.join(inventory[attr].split()))
+
+    def _print_current_inventory(self, zhost):
+        """
+        Sending attributes got by discovery, they are requested again if
+        discovery was taken from cache or sent already. Nothing is sent if
+        storage doesn't answer, old attributes would be sent as current
+        """
+        if not self._qsan._discovery_fetched:
+            try:
+                self._qsan.inventory_refresh()
+            except (RequestException, AttributeError):
+                return
+
+        self.print_inventory(zhost)
+
+        # Long-running collectors keep QSAN objects between cycles
+        self._qsan._discovery_fetched = False
+
+    def _vd_discovery(self):
+        """
+        Returns:
+        {"data": [{"{#VOLUME}": "volname"}, ... ]}
+        """
+        return {'data': [{'{#VOLUME}': self._qsan._get_VD_name_by_id(volume)}
+                         for volume in self._qsan._VDs]}
+
+    def _disk_discovery(self):
+        """
+        Returns:
+        {"data": [{"{#DISK}": "diskname"}, ... ]}
+        """
+        return {'data': [{'{#DISK}': self._qsan._get_DISK_name_by_id(disk)}
+                         for disk in self._qsan._DISKs]}
+
+    def _cp_discovery(self):
+        """
+        Returns:
+        {"data": [{"{#CACHEPOOL}": "cpname"}, ... ]}
+        """
+        return {'data': [{'{#CACHEPOOL}': cp} for cp in self._qsan._CPs]}
 
-    def print_storage_stats(self, zhost):
+    def _fc_discovery(self):
         """
         Returns:
-        zhost	qsan.sanos4.storage.iops	123
-        zhost	qsan.sanos4.storage.read	123
-        zhost	qsan.sanos4.storage.write	123
+        {"data": [{"{#FCPORT}": "portname"}, ... ]}
         """
-        for param, value in self._qsan.storage_stats().items():
-            print('\t'.join([zhost,
-                             'qsan.sanos4.storage.' + param,
-                             value]))
+        return {'data': [
+            {'{#FCPORT}': self._qsan._get_FC_port_name_by_id(port)}
+            for port in self._qsan._FCs
+        ]}
 
     def print_vd_discovery(self):
         """
         Returns:
         {"data": [{"{#VOLUME}": "volname"}, ... ]}
         """
-        for volume in self._qsan._VDs:
-            element = {'{#VOLUME}': self._qsan._get_VD_name_by_id(volume)}
-            self._DATA['data'].append(element)
-
-        print(json.dumps(self._DATA, indent=2))
+        print(json.dumps(self._vd_discovery(), indent=2))
 
     def print_disk_discovery(self):
         """
         Returns:
         {"data": [{"{#DISK}": "diskname"}, ... ]}
         """
-        for disk in self._qsan._DISKs:
-            element = {'{#DISK}': self._qsan._get_DISK_name_by_id(disk)}
-            self._DATA['data'].append(element)
-
-        print(json.dumps(self._DATA, indent=2))
+        print(json.dumps(self._disk_discovery(), indent=2))
 
     def print_cp_discovery(self):
         """
         Returns:
         {"data": [{"{#CACHEPOOL}": "cpname"}, ... ]}
         """
-        for cp in self._qsan._CPs:
-            element = {'{#CACHEPOOL}': cp}
-            self._DATA['data'].append(element)
-
-        print(json.dumps(self._DATA, indent=2))
+        print(json.dumps(self._cp_discovery(), indent=2))
 
     def print_fc_discovery(self):
         """
         Returns:
         {"data": [{"{#FCPORT}": "portname"}, ... ]}
         """
-        for port in self._qsan._FCs:
-            element = {'{#FCPORT}': self._qsan._get_FC_port_name_by_id(port)}
-            self._DATA['data'].append(element)
+        print(json.dumps(self._fc_discovery(), indent=2))
+
+    def print_all_discovery(self, zhost, state=None):
+        """
+        All discovery as values of trapper discovery rules. Discovery
+        which state (DiscoveryState) has already sent is skipped
+        Returns:
+        zhost	qsan.sanos4.discovery.volume	{"data": [...]}
+        zhost	qsan.sanos4.discovery.disk	{"data": [...]}
+        zhost	qsan.sanos4.discovery.fcport	{"data": [...]}
+        zhost	qsan.sanos4.discovery.cachepool	{"data": [...]}
+        and attributes got by discovery, see print_inventory()
+        """
+        discovery = [
+            ('volume', self._vd_discovery()),
+            ('disk', self._disk_discovery()),
+            ('fcport', self._fc_discovery()),
+            ('cachepool', self._cp_discovery())
+        ]
+
+        for kind, data in discovery:
+            key = 'qsan.sanos4.discovery.' + kind
+
+            if state and not state.changed(key, data):
+                continue
+
+            self._print_item(zhost, key,
+                             json.dumps(data, sort_keys=True,
+                                        separators=(',', ':')))
 
-        print(json.dumps(self._DATA, indent=2))
+            if state:
+                state.sent(key, data)
+
+        self.print_inventory(zhost)
 
     def print_vd_stats(self, zhost):
         """
@@ -876,9 +1716,9 @@ class Zabbix():
             n = self._qsan._get_VD_name_by_id(volume)
 
             for param, value in params.items():
-                print('\t'.join([zhost,
+                self._print_item(zhost,
                                  'qsan.sanos4.volume.' + param + '[' + n + ']',
-                                 value]))
+                                 value)
 
     def print_disk_stats(self, zhost):
         """
@@ -892,9 +1732,9 @@ class Zabbix():
             n = self._qsan._get_DISK_name_by_id(disk)
 
             for param, value in params.items():
-                print('\t'.join([zhost,
+                self._print_item(zhost,
                                  'qsan.sanos4.disk.' + param + '[' + n + ']',
-                                 value]))
+                                 value)
 
     def print_cp_stats(self, zhost):
         """
@@ -909,10 +1749,10 @@ class Zabbix():
 
         for cp, cp_params in self._qsan.cp_stats_summarize().items():
             for cp_param, cp_param_value in cp_params.items():
-                print('\t'.join([zhost,
+                self._print_item(zhost,
                                  'qsan.sanos4.cachepool.' + cp_param +
                                  '[' + cp + ']',
-                                 cp_param_value]))
+                                 cp_param_value)
 
     def print_fc_stats(self, zhost):
         """
@@ -926,18 +1766,661 @@ class Zabbix():
             n = self._qsan._get_FC_port_name_by_id(port)
 
             for param, value in params.items():
-                print('\t'.join([zhost,
+                self._print_item(zhost,
                                  'qsan.sanos4.fcport.' + param + '[' + n + ']',
-                                 value]))
+                                 value)
 
     def print_all_stats(self, zhost):
         """
+        All stats with storage health and current attributes of Volumes,
+        Disks and FC ports
         """
         self.print_vd_stats(zhost)
         self.print_storage_stats(zhost)
         self.print_disk_stats(zhost)
         self.print_fc_stats(zhost)
         self.print_cp_stats(zhost)
+        self._print_current_inventory(zhost)
+
+        # Failed health check loses only its own item
+        self.print_storage_health(zhost)
+
+    def print_json_stats(self, zhost):
+        """
+        All stats as one value for master item of dependent items
+        Returns:
+        zhost	qsan.sanos4.stats	{"storage": {"iops": "123", ...},
+                                 "volume": {"volname": {"iops": "123", ...}},
+                                 "disk": {"diskname": {...}},
+                                 "fcport": {"portname": {...}},
+                                 "cachepool": {"cpname": {...}}}
+        """
+        snapshot = self._qsan.snapshot()
+
+        stats = {'storage': snapshot.storage}
+        for kind, field in _SNAPSHOT_TYPES:
+            stats[kind] = dict((item.name, item.stats)
+                               for item in getattr(snapshot, field).values())
+
+        self._print_item(zhost, 'qsan.sanos4.stats',
+                         json.dumps(stats, sort_keys=True,
+                                    separators=(',', ':'), default=dict))
+
+        # Not always present, so sent as separate values
+        self._print_current_inventory(zhost)
+        self.print_storage_health(zhost)
+
+
+class JSONLines():
+    """
+    Class for streaming QSAN snapshots as JSON lines
+    """
+    def __init__(self, qsan):
+        """
+        """
+        self._qsan = qsan
+
+    def _print_record(self, record):
+        """
+        Returns:
+        {"host": "", "zhost": "", "clock": 123, "type": "", ...}
+        """
+        print(json.dumps(record, sort_keys=True, default=dict))
+
+    def print_snapshot(self, zhost):
+        """
+        Returns one line for storage and one line for each object:
+        {..., "type": "storage", "stats": {"iops": "123", ...}}
+        {..., "type": "volume", "id": "", "name": "volname",
+              "inventory": {...}, "stats": {"iops": "123", ...}}
+        ...
+        """
+        snapshot = self._qsan.snapshot()
+        common = {
+            'host': snapshot.host,
+            'zhost': zhost,
+            'clock': snapshot.clock,
+            'sanos_version': snapshot.sanos_version
+        }
+
+        record = dict(common, type='storage', stats=snapshot.storage)
+        self._print_record(record)
+
+        for kind, field in _SNAPSHOT_TYPES:
+            for item in getattr(snapshot, field).values():
+                record = dict(common, type=kind, **item._asdict())
+                self._print_record(record)
+
+        sys.stdout.flush()
+
+
+class Spool():
+    """
+    On-disk spool of stats batches which couldn't be pushed to Zabbix.
+    Every batch is a separate file named by its timestamp so batches are
+    consumed oldest first and never modified except the partially
+    replayed one
+    """
+    _SUFFIX = '.batch'
+
+    def __init__(self, path, max_bytes=52428800, max_age=86400):
+        """
+        Creating spool directory if needed
+        """
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._seq = 0
+        self._lock_file = None
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _batches(self):
+        """
+        Returns: list of batch files sorted from oldest to newest
+        """
+        names = [n for n in os.listdir(self._path)
+                 if n.endswith(self._SUFFIX)]
+        names.sort()
+
+        return [os.path.join(self._path, n) for n in names]
+
+    def _clock(self, batch):
+        """
+        Returns: timestamp of batch, ex.: 1556618477
+        """
+        return int(os.path.basename(batch).split('.')[0])
+
+    def _write(self, batch, lines):
+        """
+        Atomically writing lines to batch file
+        """
+        tmp = batch + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp, batch)
+
+    def _remove(self, batch):
+        """
+        Removing batch file if it wasn't removed by concurrent run
+        """
+        try:
+            os.remove(batch)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def lock(self):
+        """
+        Exclusive non-blocking lock of spool for replaying
+        Returns: True if lock was acquired
+        """
+        if self._lock_file:
+            return True
+
+        f = open(os.path.join(self._path, '.lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return False
+
+        self._lock_file = f
+
+        return True
+
+    def depth(self):
+        """
+        Returns: number of spooled batches
+        """
+        return len(self._batches())
+
+    def put(self, clock, lines):
+        """
+        Spooling batch of 'zhost	key	clock	value' lines
+        """
+        self._seq += 1
+        name = '%010d.%d.%d%s' % (clock, os.getpid(), self._seq, self._SUFFIX)
+
+        self._write(os.path.join(self._path, name), lines)
+        self.evict()
+
+    def evict(self):
+        """
+        Removing batches older than max_age and the oldest batches while
+        spool is bigger than max_bytes
+        """
+        oldest = time.time() - self._max_age
+        batches = []
+        total = 0
+
+        for batch in self._batches():
+            if self._clock(batch) < oldest:
+                self._remove(batch)
+                continue
+
+            try:
+                size = os.path.getsize(batch)
+            except OSError:
+                continue
+
+            batches.append((batch, size))
+            total += size
+
+        while batches and total > self._max_bytes:
+            batch, size = batches.pop(0)
+            self._remove(batch)
+            total -= size
+
+    def take(self, limit):
+        """
+        Reading up to limit spooled lines, oldest first
+        Returns: (lines, [fully taken batches],
+                  (partially taken batch, [rest of its lines]) or None)
+        """
+        lines = []
+        taken = []
+
+        for batch in self._batches():
+            try:
+                with open(batch) as f:
+                    batch_lines = f.read().splitlines()
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+
+            free = limit - len(lines)
+            if len(batch_lines) > free:
+                lines.extend(batch_lines[:free])
+
+                return lines, taken, (batch, batch_lines[free:])
+
+            lines.extend(batch_lines)
+            taken.append(batch)
+
+            if len(lines) == limit:
+                break
+
+        return lines, taken, None
+
+    def commit(self, taken, partial):
+        """
+        Removing delivered lines returned by take()
+        """
+        for batch in taken:
+            self._remove(batch)
+
+        if partial:
+            self._write(*partial)
+
+
+class ZabbixSender():
+    """
+    Class for pushing stats with zabbix_sender. Batches which couldn't be
+    delivered are spooled and replayed on the next runs
+    """
+
+    # Max number of spooled chunks replayed during one run
+    _REPLAY_CHUNKS = 10
+
+    def __init__(self, server, sender='/usr/bin/zabbix_sender', spool=None,
+                 chunk=1000):
+        """
+        """
+        self._server = server
+        self._sender = sender
+        self._spool = spool
+        self._chunk = chunk
+        self._lines = []
+
+    def add(self, line):
+        """
+        Adding 'zhost	key	value' line to current batch
+        """
+        self._lines.append(line)
+
+    def _send(self, lines):
+        """
+        Pushing 'zhost	key	clock	value' lines with zabbix_sender
+        Returns: True if values were delivered to Zabbix
+        """
+        data = ('\n'.join(lines) + '\n').encode('utf8')
+
+        try:
+            p = subprocess.Popen([self._sender, '-z', self._server,
+                                  '-T', '-i', '-'],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            p.communicate(data)
+        except OSError:
+            return False
+
+        # 2 means Zabbix got values but some of them were not processed,
+        # resending them won't help
+        return p.returncode in (0, 2)
+
+    def _replay(self):
+        """
+        Replaying spooled batches, oldest first, in chunks of self._chunk
+        values. Stops on the first failed chunk
+        """
+        if not self._spool.lock():
+            # Spool is being replayed by another run
+            return
+
+        self._spool.evict()
+
+        for _ in range(self._REPLAY_CHUNKS):
+            lines, taken, partial = self._spool.take(self._chunk)
+            if not lines:
+                break
+
+            if not self._send(lines):
+                break
+
+            self._spool.commit(taken, partial)
+
+    def flush(self, zhost=None):
+        """
+        Pushing current batch with spool depth of zhost, if given. Batch
+        is spooled if Zabbix is unreachable, otherwise spool is replayed
+        Returns: True if current batch was delivered
+        """
+        if not self._lines:
+            return True
+
+        if self._spool and zhost:
+            try:
+                self.add('\t'.join([zhost, 'qsan.sanos4.spool.depth',
+                                    str(self._spool.depth())]))
+            except (IOError, OSError) as e:
+                sys.stderr.write('Unable to read spool: %s\n' % e)
+
+        clock = int(time.time())
+        lines = []
+        for line in self._lines:
+            host, key, value = line.split('\t', 2)
+            value = _zabbix_value(value)
+            lines.append('\t'.join([host, key, str(clock), value]))
+
+        self._lines = []
+
+        if not self._send(lines):
+            if self._spool:
+                try:
+                    self._spool.put(clock, lines)
+                except (IOError, OSError) as e:
+                    # Batch is lost, like without spool
+                    sys.stderr.write('Unable to spool batch: %s\n' % e)
+
+            return False
+
+        if self._spool:
+            try:
+                self._replay()
+            except (IOError, OSError) as e:
+                # Current batch is delivered anyway
+                sys.stderr.write('Unable to replay spool: %s\n' % e)
+
+        return True
+
+
+class _SnapshotRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answering every 'key' line with 'value' line, empty line if key is
+    unknown
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            key = line.decode('utf8').strip()
+            value = self.server.snapshot.get(key)
+
+            self.wfile.write(((value or '') + '\n').encode('utf8'))
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """
+    """
+    daemon_threads = True
+
+
+class SnapshotServer():
+    """
+    Latest values of stats:all items served from memory over Unix domain
+    socket, so reads never make requests to storage
+    """
+
+    def __init__(self, path):
+        """
+        """
+        self._path = path
+        self._values = {}
+        self._collected = {}
+        self._server = None
+
+    def add(self, line):
+        """
+        Collecting 'zhost	key	value' line like ZabbixSender does
+        """
+        zhost, key, value = line.split('\t', 2)
+        self._collected[key] = value
+
+    def collect(self, qsan, zhost):
+        """
+        Replacing served values with new stats of qsan
+        """
+        self._collected = {}
+        Zabbix(qsan, self).print_all_stats(zhost)
+
+        # Readers get either previous or new values, never a mix
+        self._values = self._collected
+
+    def get(self, key):
+        """
+        Returns: latest value of key or None
+        """
+        return self._values.get(key)
+
+    def start(self):
+        """
+        Listening on socket in a separate thread. Stale socket file is
+        removed
+        """
+        try:
+            os.remove(self._path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self._server = _UnixServer(self._path, _SnapshotRequestHandler)
+        self._server.snapshot = self
+
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """
+        Stopping listening and removing socket file
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.remove(self._path)
+
+
+class _StackTracer():
+    """
+    sys.setprofile() tracer counting time of every call stack
+    """
+
+    def __init__(self):
+        """
+        """
+        self._stack = []
+        self._last = None
+        self.stacks = collections.Counter()
+
+    def __call__(self, frame, event, arg):
+        now = time.time()
+
+        if self._stack:
+            stack = tuple(name for name in self._stack if name)
+            self.stacks[stack] += now - self._last
+        self._last = now
+
+        if event == 'call':
+            code = frame.f_code
+            if code is Profiler.WRAPPER_CODE:
+                # Not showing Profiler phases wrappers
+                self._stack.append(None)
+            else:
+                self._stack.append(os.path.basename(code.co_filename) +
+                                   ':' + code.co_name)
+        elif event == 'c_call':
+            self._stack.append(
+                (getattr(arg, '__module__', None) or 'builtins') + ':' +
+                getattr(arg, '__qualname__', arg.__name__))
+        elif self._stack:
+            # return, c_return, c_exception
+            self._stack.pop()
+
+    def dump(self, path):
+        """
+        Writing collapsed stacks with time in microseconds:
+        qsan.py:main;qsan.py:run;qsan.py:print_all_stats 123
+        """
+        with open(path, 'w') as f:
+            for stack, seconds in sorted(self.stacks.items()):
+                f.write(';'.join(stack) + ' ' +
+                        str(int(seconds * 1000000)) + '\n')
+
+
+class Profiler():
+    """
+    Profiling of a run: time of phases and cProfile dump or collapsed
+    stacks of all calls
+    """
+
+    # Phases and methods they consist of
+    _PHASES = [
+        ('login', QSAN, '_authorize'),
+        ('version detection', QSAN, '_sanos_version_detect'),
+        ('vd_discovery', QSAN, 'vd_discovery'),
+        ('disk_discovery', QSAN, 'disk_discovery'),
+        ('cache_pool_discovery', QSAN, 'cache_pool_discovery'),
+        ('fc_discovery', QSAN, 'fc_discovery'),
+        ('storage_stats', QSAN, 'storage_stats'),
+        ('vd_stats', QSAN, 'vd_stats'),
+        ('disk_stats', QSAN, 'disk_stats'),
+        ('fc_stats', QSAN, 'fc_stats'),
+        ('cp_stats', QSAN, 'cp_stats'),
+        ('is_storage_health_Good', QSAN, 'is_storage_health_Good'),
+        ('http requests', QSAN, '_connection'),
+        ('soup parsing', BaseQSAN, '_bs4'),
+        ('output formatting', Zabbix, '_print_item'),
+        ('output formatting', JSONLines, '_print_record'),
+        ('zabbix_sender', ZabbixSender, '_send')
+    ]
+
+    def __init__(self, path, format='pstats'):
+        """
+        """
+        self._path = path
+        self._format = format
+        self._stack = []
+        self._phases = {}
+        self._wall = 0
+
+    def _startup_time(self):
+        """
+        Returns: seconds since process start (interpreter startup and
+        imports) or None if unknown
+        """
+        try:
+            with open('/proc/self/stat') as f:
+                starttime = int(f.read().rsplit(')', 1)[1].split()[19])
+            with open('/proc/uptime') as f:
+                uptime = float(f.read().split()[0])
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+
+        return max(uptime - float(starttime) / os.sysconf('SC_CLK_TCK'), 0)
+
+    def _enter(self):
+        """
+        Starting phase
+        """
+        self._stack.append([time.time(), 0])
+
+    def _exit(self, phase):
+        """
+        Finishing phase, nested phases are excluded from its self time
+        """
+        start, nested = self._stack.pop()
+        elapsed = time.time() - start
+
+        stats = self._phases.setdefault(phase, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - nested
+
+        if self._stack:
+            self._stack[-1][1] += elapsed
+
+    def _wrap(self, phase, method):
+        """
+        Returns: method counting its time in phase
+        """
+        def wrapper(*args, **kwargs):
+            self._enter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._exit(phase)
+
+        return wrapper
+
+    WRAPPER_CODE = _wrap(None, None, None).__code__
+
+    def run(self, func, *args):
+        """
+        Running func(*args) with profiling
+        """
+        startup = self._startup_time()
+        if startup is not None:
+            self._phases['startup and imports'] = [1, startup, startup]
+
+        originals = []
+        for phase, cls, name in self._PHASES:
+            method = cls.__dict__[name]
+            originals.append((cls, name, method))
+            setattr(cls, name, self._wrap(phase, method))
+
+        if self._format == 'collapsed':
+            profile = _StackTracer()
+            sys.setprofile(profile)
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        start = time.time()
+        try:
+            func(*args)
+        finally:
+            self._wall = time.time() - start
+
+            if self._format == 'collapsed':
+                sys.setprofile(None)
+            else:
+                profile.disable()
+
+            for cls, name, method in originals:
+                setattr(cls, name, method)
+
+            if self._format == 'collapsed':
+                profile.dump(self._path)
+            else:
+                profile.dump_stats(self._path)
+
+    def report(self, stream=sys.stderr):
+        """
+        Writing time of phases:
+        Phase                      Calls    Total, s     Self, s       %
+        login                          1       0.012       0.001     0.5
+        ...
+        """
+        wall = self._wall
+        if 'startup and imports' in self._phases:
+            wall += self._phases['startup and imports'][1]
+
+        self_total = sum(stats[2] for stats in self._phases.values())
+
+        phases = []
+        for phase in ['startup and imports'] + [p[0] for p in self._PHASES]:
+            if phase in self._phases and phase not in dict(phases):
+                phases.append((phase, self._phases[phase]))
+        phases.append(('other', [0, 0, max(wall - self_total, 0)]))
+
+        stream.write('%-26s %5s %11s %11s %7s\n' %
+                     ('Phase', 'Calls', 'Total, s', 'Self, s', '%'))
+        for phase, (calls, total, self_time) in phases:
+            stream.write('%-26s %5d %11.3f %11.3f %7.1f\n' %
+                         (phase, calls, total, self_time,
+                          self_time / wall * 100 if wall else 0))
+        stream.write('%-26s %5s %11.3f\n' % ('wall', '', wall))
 
 
 def main():
@@ -945,28 +2428,146 @@ def main():
     """
     args = argumentsparsing()
 
-    qsan = QSAN(args.host, args.username, args.password)
-    zabbix = Zabbix(qsan)
+    if args.method == 'serve':
+        serve(args)
+    elif args.profile:
+        profiler = Profiler(args.profile, args.profile_format)
+        profiler.run(connect_and_run, args)
+        profiler.report()
+    else:
+        connect_and_run(args)
+
+
+def serve(args):
+    """
+    Collecting stats every args.interval seconds and serving them on
+    args.socket. Discovery is repeated every args.cache_ttl seconds
+    """
+    if not args.zhost:
+        args.zhost = 'zabbix host undefined'
+
+    server = SnapshotServer(args.socket)
+    server.start()
 
+    qsan = None
+    discovered = 0
+    try:
+        while True:
+            start = time.time()
+
+            if start - discovered >= args.cache_ttl:
+                qsan = None
+
+            try:
+                if qsan is None:
+                    qsan = QSAN(args.host, args.username, args.password)
+                    discovered = start
+
+                server.collect(qsan, args.zhost)
+            except Exception as e:
+                # Previous values are served until storage is back
+                sys.stderr.write('Collection failed: %s\n' % e)
+                qsan = None
+
+            time.sleep(max(args.interval - (time.time() - start), 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def connect_and_run(args):
+    """
+    Connecting to storage and running args.method
+    """
+    recorder = None
+    if args.record:
+        recorder = Recorder(args.record, args.host)
+
+    adapter = None
+    if args.replay:
+        adapter = ReplayAdapter(args.replay, args.host,
+                                args.replay_latency == 'original')
+
+    cache = None
+    if args.cache_dir and not (args.record or args.replay):
+        cache = DiscoveryCache(args.cache_dir, args.host, args.cache_ttl,
+                               args.method.startswith('discovery:'))
+
+    try:
+        qsan = QSAN(args.host, args.username, args.password,
+                    recorder, adapter, cache)
+        run(args, qsan)
+    finally:
+        if recorder:
+            recorder.close()
+
+
+def run(args, qsan):
+    """
+    Running args.method
+    """
     if not args.zhost:
         args.zhost = 'zabbix host undefined'
 
+    sender = None
+    if args.zserver:
+        spool = None
+        if args.spool_dir:
+            try:
+                spool = Spool(os.path.join(args.spool_dir,
+                                           args.zhost.replace(os.sep, '_')),
+                              args.spool_max_bytes, args.spool_max_age)
+            except (IOError, OSError) as e:
+                # Stats are still pushed, only not spooled
+                sys.stderr.write('Spool is disabled: %s\n' % e)
+
+        sender = ZabbixSender(args.zserver, args.zsender, spool,
+                              args.spool_chunk)
+
+    zabbix = Zabbix(qsan, sender)
+
+    # Delivery of printed discovery is unknown, so it's always printed
+    state = None
+    if args.method == 'discovery:all' and args.cache_dir and sender:
+        try:
+            state = DiscoveryState(args.cache_dir, args.zhost,
+                                   args.discovery_heartbeat)
+        except (IOError, OSError) as e:
+            # Discovery is sent every run
+            sys.stderr.write('Discovery state is disabled: %s\n' % e)
+
+    if args.format == 'jsonl':
+        JSONLines(qsan).print_snapshot(args.zhost)
+        return
+
     methods = {
         'discovery:volume': lambda: zabbix.print_vd_discovery(),
         'discovery:disk': lambda: zabbix.print_disk_discovery(),
         'discovery:fc': lambda: zabbix.print_fc_discovery(),
         'discovery:cp': lambda: zabbix.print_cp_discovery(),
+        'discovery:all': lambda: zabbix.print_all_discovery(args.zhost,
+                                                            state),
         'stats:volume': lambda: zabbix.print_vd_stats(args.zhost),
         'stats:storage': lambda: zabbix.print_storage_stats(args.zhost),
         'stats:disk': lambda: zabbix.print_disk_stats(args.zhost),
         'stats:cp': lambda: zabbix.print_cp_stats(args.zhost),
-        'stats:all': lambda: zabbix.print_all_stats(args.zhost)
+        'stats:all': lambda: zabbix.print_all_stats(args.zhost),
+        'stats:json': lambda: zabbix.print_json_stats(args.zhost)
     }
 
     m = methods.get(args.method)
     if m:
         m()
 
+    if sender:
+        delivered = sender.flush(args.zhost)
+
+        # Spooled discovery may be evicted before it's replayed, so it's
+        # sent again next run
+        if state and delivered:
+            state.save()
+
 
 if __name__ == '__main__':
     main()
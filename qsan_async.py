@@ -0,0 +1,389 @@
+# encoding: utf8
+"""
+asyncio client for QSAN storages. Lets one event loop collect stats of
+many storages concurrently. Requires Python 3.7+ and aiohttp.
+
+Running module benchmarks AsyncQSAN against serial QSAN runs using
+emulated arrays from qsan_mock.py:
+
+    $ python qsan_async.py --arrays 50 --latency 0.05
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from requests.exceptions import RequestException
+
+from qsan import BaseQSAN, QSAN
+
+
+def argumentsparsing():
+    """
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arrays", dest="arrays", type=int, default=20,
+                        help="Number of emulated arrays " +
+                             "[default: %(default)s]")
+    parser.add_argument("--volumes", dest="volumes", type=int, default=8,
+                        help="Volumes per array [default: %(default)s]")
+    parser.add_argument("--disks", dest="disks", type=int, default=24,
+                        help="Disks per array [default: %(default)s]")
+    parser.add_argument("--latency", dest="latency", type=float,
+                        default=0.05,
+                        help="Array response latency in seconds " +
+                             "[default: %(default)s]")
+    parser.add_argument("--concurrency", dest="concurrency", type=int,
+                        default=2,
+                        help="Max concurrent requests per array " +
+                             "[default: %(default)s]")
+
+    return parser.parse_args()
+
+
+class AsyncQSAN(BaseQSAN):
+    """
+    asyncio class for operationing with qsan. Has the same methods as QSAN
+    but they are coroutines. Use AsyncQSAN.create() to connect and make
+    discovery like QSAN() does
+    """
+
+    def __init__(self, host=None, username='user', password='1234',
+                 concurrency=2, connector=None):
+        """
+        concurrency limits simultaneous requests to this storage,
+        connector is aiohttp.TCPConnector shared between storages
+        """
+        BaseQSAN.__init__(self, host, username, password)
+        self._concurrency = concurrency
+        self._connector = connector
+        self._semaphore = None
+        self._session = None
+        self._headers = dict((k, v) for k, v in self._HEADERS.items()
+                             if v is not None)
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """
+        Connecting to QSAN storage. Making discovery of Volumes, Disks,
+        Cache Pools and FC ports
+        Returns: AsyncQSAN object
+        """
+        qsan = cls(*args, **kwargs)
+
+        try:
+            await qsan.connect()
+            await asyncio.gather(qsan.vd_discovery(),
+                                 qsan.disk_discovery(),
+                                 qsan.cache_pool_discovery(),
+                                 qsan.fc_discovery())
+            qsan._detect_capabilities()
+        except Exception:
+            await qsan.close()
+            raise
+
+        return qsan
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """
+        Closing session
+        """
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _connection_init(self):
+        """
+        Establishing new session with its own cookies
+        """
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            connector_owner=self._connector is None,
+            timeout=aiohttp.ClientTimeout(total=self._connection_timeout))
+
+    async def _connection(self, url, post=False, data=None):
+        """
+        Main connection method
+        Returns: BeautifulSoup object if got succesfull HTTP response
+        """
+        try:
+            async with self._semaphore:
+                async with self._session.request('POST' if post else 'GET',
+                                                 url,
+                                                 headers=self._headers,
+                                                 data=data) as r:
+                    text = await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise RequestException('Error making request: ' + str(e))
+
+        if not (r.status < 400 or r.status == 302):
+            raise RequestException('Something wrong with request')
+
+        return self._bs4(text)
+
+    async def connect(self):
+        """
+        Common connect method. Detects SANOS version by login page
+        """
+        await self.close()
+        self._connection_init()
+
+        soup = await self._connection(self._url + self._url_path_login,
+                                      post=True,
+                                      data=self._login_keys())
+
+        if not self._is_authorized(soup):
+            raise RequestException('Unable to authorize!')
+
+        self._SANOS_VERSION = self._parse_sanos_version(soup)
+
+    async def storage_stats(self):
+        """
+        Getting stats from dashboard
+        Returns: {'iops': '10764', 'read': '282640625', 'write': '1255703125'}
+        """
+        if not self._capabilities['storage_stats']:
+            return {}
+
+        soup = await self._connection(self._url + self._url_path_data)
+
+        return self._parse_storage_stats(soup)
+
+    async def is_storage_health_Good(self):
+        """
+        Method for getting storage health status
+        Returns: True if Good, False if storage is in Degraded state or None
+        if unable to check state
+        """
+        soup = await self._connection(self._health_url())
+
+        return self._parse_health(soup)
+
+    async def vd_discovery(self):
+        """
+        Getting Volumes information from Storage
+        Fills self._VDs
+        """
+        page = 1
+        VDs = {}
+
+        while True:
+            # Iteration over pages
+            params = '&page=' + str(page)
+
+            soup = await self._connection(self._url + self._url_path_VD +
+                                          params)
+
+            VD_count, page_VDs, next_page = self._parse_vd_page(soup)
+            VDs.update(page_VDs)
+            if next_page:
+                page += 1
+
+            if len(VDs) == VD_count:
+                break
+
+        self._VDs = VDs
+
+    async def vd_stats(self):
+        """
+        Getting Volumes stats
+        Returns: {'id': {'iops': 123, 'read': 123, 'write': 123}}
+        """
+        volumes_IDs = [volume for volume in self._VDs]
+
+        soup = await self._connection(self._url + self._url_path_VD_stats)
+        VDstats, volumes_monitoring_check = self._parse_vd_stats(soup)
+
+        # Enabling monitoring of unmonitored VDs
+        if set(volumes_monitoring_check) != set(volumes_IDs):
+            await self._connection(self._vd_stats_enable_url(volumes_IDs),
+                                   post=True)
+
+        return VDstats
+
+    async def disk_discovery(self):
+        """
+        Getting Disk information from Storage
+        Fills self._DISKs
+        """
+        soup = await self._connection(self._url + self._url_path_DISK)
+
+        self._DISKs = self._parse_disks(soup)
+
+    async def disk_stats(self):
+        """
+        Getting Disks stats
+        Returns: {id: {'latency': '123', 'thruput': '123'}}
+        """
+        disks_IDs = [disk for disk in self._DISKs]
+
+        soup = await self._connection(self._url + self._url_path_DISK_stats)
+        DISKstats, disks_monitoring_check = self._parse_disk_stats(soup)
+
+        # Enabling monitoring of unmonitored DISKs
+        if set(disks_monitoring_check) != set(disks_IDs):
+            await self._connection(self._disk_stats_enable_url(disks_IDs),
+                                   post=True)
+
+        return DISKstats
+
+    async def cache_pool_discovery(self):
+        """
+        Getting Cache Pools (CPs) information from Storage
+        Fills self._CPs
+        """
+        if self._SANOS_VERSION == 3:
+            # Have no information about Cache Pools support in SANOS3
+            return {}
+
+        soup = await self._connection(self._url + self._url_path_CP)
+
+        self._CPs = self._parse_cps(soup)
+
+    async def cp_stats(self):
+        """
+        Getting Cache Pool stats (separate stats for each
+        ssd-enabled vd in pool)
+        Returns: the same as QSAN.cp_stats()
+        """
+        if not self._capabilities['cache_pools']:
+            return {}
+
+        soup = await self._connection(self._url + self._url_path_CP_stats)
+
+        return self._parse_cp_stats(soup)
+
+    async def cp_stats_summarize(self):
+        """
+        Getting some of Cache Pool stats in summary by Volumes
+        Returns: the same as QSAN.cp_stats_summarize()
+        """
+        return self._cp_stats_summarize(await self.cp_stats())
+
+    async def fc_discovery(self):
+        """
+        Getting FC Ports information from Storage
+        Fills self._FCs
+        """
+        controllers = self._capabilities['controllers']
+
+        # Requesting Controllers concurrently
+        soups = await asyncio.gather(*[
+            self._connection(self._url + self._url_path_FC + controller)
+            for controller in controllers
+        ])
+
+        FCs = {}
+        for controller, soup in zip(controllers, soups):
+            FCs.update(self._parse_fcs(soup, controller))
+
+        self._FCs = FCs
+        self._capabilities['controllers'] = [
+            controller for controller, soup in zip(controllers, soups)
+            if soup.response
+        ]
+
+    async def fc_stats(self):
+        """
+        Getting FC ports stats
+        Returns: {'slot:port': {'tx': '123', 'rx': '123'}}
+        """
+        if not self._capabilities['fc']:
+            return {}
+
+        ports_IDs = [port for port in self._FCs]
+
+        soup = await self._connection(self._url + self._url_path_FC_stats)
+        FCstats, ports_monitoring_check = self._parse_fc_stats(soup)
+
+        FCs = self._fc_stats_to_enable(ports_IDs, ports_monitoring_check)
+        if FCs:
+            for url, data in self._fc_stats_enable_requests(FCs):
+                await self._connection(url, post=True, data=data)
+
+        return FCstats
+
+    async def snapshot(self):
+        """
+        Getting inventory and all stats in one collection pass
+        Returns: Snapshot with read-only mappings
+        """
+        clock = int(time.time())
+
+        stats = await asyncio.gather(self.storage_stats(),
+                                     self.vd_stats(),
+                                     self.disk_stats(),
+                                     self.fc_stats(),
+                                     self.cp_stats_summarize())
+
+        return self._snapshot(clock, *stats)
+
+
+async def collect(hosts, username='user', password='1234', concurrency=2,
+                  limit=100):
+    """
+    Collecting snapshots of many storages with one event loop.
+    concurrency limits simultaneous requests per storage, limit - total
+    number of simultaneous connections
+    Returns: {host: Snapshot or Exception}
+    """
+    connector = aiohttp.TCPConnector(limit=limit)
+
+    async def snapshot(host):
+        qsan = await AsyncQSAN.create(host, username, password,
+                                      concurrency=concurrency,
+                                      connector=connector)
+        async with qsan:
+            return await qsan.snapshot()
+
+    try:
+        results = await asyncio.gather(*[snapshot(host) for host in hosts],
+                                       return_exceptions=True)
+    finally:
+        await connector.close()
+
+    return dict(zip(hosts, results))
+
+
+def main():
+    """
+    """
+    from qsan_mock import MockFleet
+
+    args = argumentsparsing()
+
+    with MockFleet(args.arrays, volumes=args.volumes, disks=args.disks,
+                   latency=args.latency) as fleet:
+        # Enabling monitoring of emulated objects before measuring
+        asyncio.run(collect(fleet.addresses, concurrency=args.concurrency))
+
+        start = time.time()
+        for host in fleet.addresses:
+            QSAN(host).snapshot()
+        serial = time.time() - start
+
+        start = time.time()
+        results = asyncio.run(collect(fleet.addresses,
+                                      concurrency=args.concurrency))
+        concurrent = time.time() - start
+
+    errors = [r for r in results.values() if isinstance(r, Exception)]
+
+    print('Arrays: %d, volumes: %d, disks: %d, latency: %.3fs' %
+          (args.arrays, args.volumes, args.disks, args.latency))
+    print('QSAN serial:      %8.3fs  %7.1f arrays/s' %
+          (serial, args.arrays / serial))
+    print('AsyncQSAN:        %8.3fs  %7.1f arrays/s' %
+          (concurrent, args.arrays / concurrent))
+    print('Errors: %d' % len(errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,673 @@
+# encoding: utf8
+"""
+Collecting stats of many storages with a pool of worker processes.
+Storages are sharded across workers by consistent hashing, so parsing is
+spread over cores, changing number of workers moves only a part of
+storages and a crashed worker affects only its shard until it's
+restarted:
+
+    $ python qsan_fleet.py --arrays arrays.txt --workers 4 \\
+        --zserver <IP_of_Zabbix_traps_receiver>
+
+arrays.txt has one storage per line:
+
+    # host         zabbix host    group (optional)
+    10.0.148.9     storage-1      dc1
+    10.0.148.10    storage-2      dc2
+
+Workers keep sessions to their storages between cycles and share
+discovery and detected capabilities in SQLite database (--store). Stats
+are sent back to the supervisor which pushes them with one zabbix_sender
+batch. With --aggregate-host the supervisor also sends fleet and group
+totals of every collection cycle to that Zabbix host, see Rollup.
+"""
+import argparse
+import bisect
+import collections
+import hashlib
+import json
+import multiprocessing
+import sqlite3
+import sys
+import time
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from qsan import (QSAN, Zabbix, ZabbixSender, Spool, DiscoveryCache,
+                  DiscoveryState, _zabbix_value)
+
+# Storage of the fleet
+FleetArray = collections.namedtuple('FleetArray', [
+    'host',   # QSAN IP-address or FQDN
+    'zhost',  # Storage name in Zabbix
+    'group'   # Group name or None
+])
+
+
+def argumentsparsing():
+    """
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arrays", dest="arrays", required=True, type=str,
+                        metavar="FILE",
+                        help="File with 'host zhost [group]' line for " +
+                             "every storage")
+    parser.add_argument("--workers", dest="workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes " +
+                             "[default: %(default)s]")
+    parser.add_argument("--interval", dest="interval", type=int, default=60,
+                        help="Seconds between collections " +
+                             "[default: %(default)s]")
+    parser.add_argument("--cycles", dest="cycles", type=int, default=0,
+                        help="Number of collections, 0 to run until " +
+                             "interrupted [default: %(default)s]")
+    parser.add_argument("--username", type=str, dest="username",
+                        default="user",
+                        help="QSAN readonly username [default: %(default)s]")
+    parser.add_argument("--password", type=str, dest="password",
+                        default="1234",
+                        help="QSAN user password [default: %(default)s]")
+    parser.add_argument("--store", type=str, dest="store",
+                        default="/var/tmp/qsan-sanos4-zabbix-fleet.sqlite",
+                        help="SQLite database with discovery shared by " +
+                             "workers [default: %(default)s]")
+    parser.add_argument("--cache-ttl", type=int, dest="cache_ttl",
+                        default=3600,
+                        help="Seconds discovery is reused for " +
+                             "[default: %(default)s]")
+    parser.add_argument("--aggregate-host", type=str, dest="aggregate_host",
+                        help="Zabbix host to send fleet and group totals " +
+                             "of every cycle to")
+    parser.add_argument("--cache-dir", type=str, dest="cache_dir",
+                        default="/var/tmp/qsan-sanos4-zabbix-cache",
+                        help="Directory for hashes of sent groups " +
+                             "discovery of --aggregate-host, empty to send " +
+                             "it every interval [default: %(default)s]")
+    parser.add_argument("--discovery-heartbeat", type=int,
+                        dest="discovery_heartbeat", default=86400,
+                        help="Groups discovery is sent only if it " +
+                             "changed or this number of seconds passed " +
+                             "[default: %(default)s]")
+    parser.add_argument("--zserver", type=str, dest="zserver",
+                        help="Zabbix server or proxy to push stats to " +
+                             "with zabbix_sender. Stats are printed to " +
+                             "stdout if not set")
+    parser.add_argument("--zhost", type=str, dest="zhost",
+                        help="Zabbix host of the collector itself, gets " +
+                             "qsan.sanos4.spool.depth. --aggregate-host " +
+                             "if not set")
+    parser.add_argument("--zsender", type=str, dest="zsender",
+                        default="/usr/bin/zabbix_sender",
+                        help="Path to zabbix_sender [default: %(default)s]")
+    parser.add_argument("--flush-interval", type=float,
+                        dest="flush_interval", default=5,
+                        help="Seconds stats are batched for before " +
+                             "pushing [default: %(default)s]")
+    parser.add_argument("--spool-dir", type=str, dest="spool_dir",
+                        default="/var/tmp/qsan-sanos4-zabbix-fleet",
+                        help="Directory for stats which couldn't be " +
+                             "pushed to --zserver [default: %(default)s]")
+    parser.add_argument("--spool-max-bytes", type=int,
+                        dest="spool_max_bytes", default=52428800,
+                        help="Spool size limit, oldest batches are " +
+                             "evicted [default: %(default)s]")
+    parser.add_argument("--spool-max-age", type=int, dest="spool_max_age",
+                        default=86400,
+                        help="Spooled batches older than this number of " +
+                             "seconds are evicted [default: %(default)s]")
+    parser.add_argument("--spool-chunk", type=int, dest="spool_chunk",
+                        default=1000,
+                        help="Max number of spooled values replayed with " +
+                             "one zabbix_sender run [default: %(default)s]")
+
+    return parser.parse_args()
+
+
+def read_arrays(path):
+    """
+    Returns: [FleetArray, ... ] from file with 'host zhost [group]' lines
+    """
+    arrays = []
+
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+
+            if len(fields) not in (2, 3):
+                raise ValueError('Expected "host zhost [group]": ' + line)
+
+            fields.append(None)
+            arrays.append(FleetArray(*fields[:3]))
+
+    return arrays
+
+
+class HashRing():
+    """
+    Consistent hashing of storages to workers
+    """
+
+    def __init__(self, nodes, replicas=100):
+        """
+        Every node is placed to the ring replicas times
+        """
+        self._ring = sorted((self._hash('%s-%d' % (node, i)), node)
+                            for node in nodes
+                            for i in range(replicas))
+        self._hashes = [h for h, node in self._ring]
+
+    def _hash(self, key):
+        """
+        Returns: int hash of key
+        """
+        return int(hashlib.md5(key.encode('utf8')).hexdigest()[:8], 16)
+
+    def node(self, key):
+        """
+        Returns: node key belongs to
+        """
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+
+        return self._ring[i][1]
+
+
+class DiscoveryStore():
+    """
+    Discovery of storages shared by processes in SQLite database in WAL
+    mode, so readers don't wait for writers
+    """
+
+    def __init__(self, path):
+        """
+        """
+        self._path = path
+        self._db = None
+
+    def _connect(self):
+        """
+        Connecting on first use, so every process has its own connection
+        Returns: sqlite3 connection
+        """
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, timeout=30)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS discovery ('
+                             'host TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            self._db.commit()
+
+        return self._db
+
+    def read(self, host):
+        """
+        Returns: saved discovery of host or None
+        """
+        row = self._connect().execute(
+            'SELECT data FROM discovery WHERE host = ?', (host,)).fetchone()
+
+        if row:
+            return json.loads(row[0])
+
+    def write(self, host, data):
+        """
+        Saving discovery of host
+        """
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO discovery (host, data) '
+                       'VALUES (?, ?)', (host, json.dumps(data)))
+
+    def cache(self, host, ttl=3600):
+        """
+        Returns: DiscoveryCache of host kept in this store
+        """
+        return StoreDiscoveryCache(self, host, ttl)
+
+
+class StoreDiscoveryCache(DiscoveryCache):
+    """
+    DiscoveryCache kept in DiscoveryStore instead of a file
+    """
+
+    def __init__(self, store, host, ttl=3600, refresh=False):
+        """
+        """
+        self._store = store
+        self._host = host
+        self._ttl = ttl
+        self._refresh = refresh
+        self._disabled = False
+
+    def _read(self):
+        return self._store.read(self._host)
+
+    def _write(self, data):
+        self._store.write(self._host, data)
+
+
+class Rollup():
+    """
+    Fleet and group aggregates of stats lines of storages, so Zabbix
+    doesn't have to calculate them over many hosts
+    """
+
+    # Item of storage: (aggregate, function)
+    _AGGREGATES = {
+        'storage.iops': ('iops', sum),
+        'storage.read': ('read', sum),
+        'storage.write': ('write', sum),
+        'volume.iops': ('volume_iops', sum),
+        'volume.read': ('volume_read', sum),
+        'volume.write': ('volume_write', sum),
+        'fcport.tx': ('fc_tx', sum),
+        'fcport.rx': ('fc_rx', sum),
+        'disk.latency': ('disk_latency_max', max),
+        'cachepool.ratio': ('cachepool_ratio_min', min)
+    }
+
+    def __init__(self):
+        """
+        """
+        self._storages = {}  # host: (group, {aggregate: [values]})
+
+    def add(self, host, group, lines):
+        """
+        Adding 'zhost	key	value' lines of storage host of group. Lines
+        added for the same host before are replaced
+        """
+        values = {}
+
+        for line in lines:
+            zhost, key, value = line.split('\t', 2)
+            item = key[len('qsan.sanos4.'):].split('[', 1)[0]
+
+            if item not in self._AGGREGATES:
+                continue
+
+            try:
+                value = int(float(value))
+            except ValueError:
+                # Empty values of storages which did not report them
+                continue
+
+            values.setdefault(self._AGGREGATES[item][0], []).append(value)
+
+        self._storages[host] = (group, values)
+
+    def arrays(self):
+        """
+        Returns: number of added storages
+        """
+        return len(self._storages)
+
+    def groups(self):
+        """
+        Returns: names of groups of added storages
+        """
+        return sorted(set(group for group, values in self._storages.values()
+                          if group is not None))
+
+    def _aggregate(self, storages):
+        """
+        Returns: {aggregate: value} of given storages values
+        """
+        functions = dict(self._AGGREGATES.values())
+        merged = {}
+
+        for values in storages:
+            for aggregate, v in values.items():
+                merged.setdefault(aggregate, []).extend(v)
+
+        aggregates = dict((aggregate, functions[aggregate](v))
+                          for aggregate, v in merged.items())
+        aggregates['arrays'] = len(storages)
+
+        return aggregates
+
+    def lines(self, zhost):
+        """
+        Returns:
+        zhost	qsan.sanos4.fleet.arrays	10
+        zhost	qsan.sanos4.fleet.iops	123
+        zhost	qsan.sanos4.group.iops[group]	123
+        ...
+        """
+        lines = []
+
+        aggregates = self._aggregate([values for group, values
+                                      in self._storages.values()])
+        for aggregate, value in sorted(aggregates.items()):
+            lines.append('\t'.join([zhost, 'qsan.sanos4.fleet.' + aggregate,
+                                    str(value)]))
+
+        for g in self.groups():
+            aggregates = self._aggregate([values for group, values
+                                          in self._storages.values()
+                                          if group == g])
+            for aggregate, value in sorted(aggregates.items()):
+                lines.append('\t'.join([zhost,
+                                        'qsan.sanos4.group.' + aggregate +
+                                        '[' + g + ']',
+                                        str(value)]))
+
+        return lines
+
+
+class _Lines(list):
+    """
+    Collecting 'zhost	key	value' lines like ZabbixSender does
+    """
+
+    def add(self, line):
+        self.append(line)
+
+
+class Worker():
+    """
+    Collecting stats of a shard of storages every interval
+    """
+
+    def __init__(self, index, arrays, args, results, store, epoch):
+        """
+        Stats are put to results queue as (host, cycle, lines). Cycles of
+        all workers start every interval since epoch
+        """
+        self._epoch = epoch
+        self._index = index
+        self._arrays = arrays
+        self._args = args
+        self._results = results
+        self._store = store
+        self._storages = {}  # host: (QSAN, time of its creation)
+
+    def _collect(self, array):
+        """
+        Storage is connected again and its discovery is refreshed every
+        cache_ttl seconds
+        Returns: stats:all lines of array
+        """
+        qsan, created = self._storages.get(array.host, (None, 0))
+
+        if time.time() - created >= self._args.cache_ttl:
+            qsan = QSAN(array.host, self._args.username, self._args.password,
+                        cache=self._store.cache(array.host,
+                                                self._args.cache_ttl))
+            self._storages[array.host] = (qsan, time.time())
+
+        lines = _Lines()
+        Zabbix(qsan, lines).print_all_stats(array.zhost)
+
+        return list(lines)
+
+    def run(self):
+        """
+        Running args.cycles collections or forever
+        """
+        interval = self._args.interval
+        cycle = 0
+
+        while True:
+            start = time.time()
+
+            n = cycle
+            if interval:
+                # Number of cycle in the whole fleet
+                n = int(round((start - self._epoch) / interval))
+
+            for array in self._arrays:
+                try:
+                    lines = self._collect(array)
+                except Exception as e:
+                    sys.stderr.write('Worker %d: %s: %s\n' %
+                                     (self._index, array.host, e))
+                    # Connecting again on the next cycle
+                    self._storages.pop(array.host, None)
+                    continue
+
+                self._results.put((array.host, n, lines))
+
+            cycle += 1
+            if cycle == self._args.cycles:
+                break
+
+            time.sleep(max(self._epoch + (n + 1) * interval - time.time(), 0))
+
+
+def _run_worker(index, arrays, args, results, store, epoch):
+    """
+    Worker process entry point
+    """
+    try:
+        Worker(index, arrays, args, results, store, epoch).run()
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor():
+    """
+    Running workers, restarting crashed ones and pushing their stats
+    """
+
+    # Max seconds crashed worker is restarted after
+    _RESTART_DELAY_MAX = 60
+
+    def __init__(self, args, arrays, sender=None):
+        """
+        Stats are printed to stdout or passed to sender (ZabbixSender)
+        if given
+        """
+        self._args = args
+        self._sender = sender
+        self._results = multiprocessing.Queue()
+        self._store = DiscoveryStore(args.store)
+        self._processes = {}
+        self._started = {}   # index: time worker was started
+        self._crashes = {}   # index: number of consecutive crashes
+        self._restarts = {}  # index: time crashed worker is restarted at
+        self._epoch = time.time()
+        self._groups = dict((array.host, array.group) for array in arrays)
+        self._rollups = {}  # cycle: Rollup
+        self._aggregated = -1  # Last cycle aggregates were sent for
+
+        # Delivery of printed discovery is unknown, so it's always printed
+        self._state = None
+        self._unconfirmed = None  # (key, data) of discovery being sent
+        if args.aggregate_host and args.cache_dir and sender:
+            try:
+                self._state = DiscoveryState(args.cache_dir,
+                                             args.aggregate_host,
+                                             args.discovery_heartbeat)
+            except (IOError, OSError) as e:
+                # Groups discovery is sent every cycle
+                sys.stderr.write('Discovery state is disabled: %s\n' % e)
+
+        ring = HashRing(range(args.workers))
+        self.shards = dict((index, []) for index in range(args.workers))
+        for array in arrays:
+            self.shards[ring.node(array.host)].append(array)
+
+    def _start(self, index):
+        """
+        Starting worker of shard index
+        """
+        p = multiprocessing.Process(target=_run_worker,
+                                    args=(index, self.shards[index],
+                                          self._args, self._results,
+                                          self._store, self._epoch))
+        p.daemon = True
+        p.start()
+
+        self._processes[index] = p
+        self._started[index] = time.time()
+
+    def _check(self):
+        """
+        Restarting crashed workers. Delay before restart doubles with every
+        consecutive crash, so a worker failing at start doesn't spin
+        Returns: True if some worker is running
+        """
+        running = False
+        now = time.time()
+
+        for index, p in list(self._processes.items()):
+            if p.is_alive():
+                running = True
+            elif p.exitcode != 0:
+                running = True
+
+                if index not in self._restarts:
+                    # Crash of a worker which ran for a while is a new one
+                    if now - self._started[index] >= self._RESTART_DELAY_MAX:
+                        self._crashes[index] = 0
+                    self._crashes[index] = self._crashes.get(index, 0) + 1
+
+                    delay = min(2 ** (self._crashes[index] - 1),
+                                self._RESTART_DELAY_MAX)
+                    self._restarts[index] = now + delay
+                    sys.stderr.write('Worker %d exited with code %s, ' %
+                                     (index, p.exitcode) +
+                                     'restarting in %ds\n' % delay)
+
+                if now >= self._restarts[index]:
+                    del self._restarts[index]
+                    self._start(index)
+
+        return running
+
+    def _output(self, lines):
+        """
+        Passing lines to sender or printing them
+        """
+        for line in lines:
+            if self._sender:
+                self._sender.add(line)
+            else:
+                zhost, key, value = line.split('\t', 2)
+                print('\t'.join([zhost, key, _zabbix_value(value)]))
+
+    def _send_aggregates(self, rollup):
+        """
+        Sending aggregates of one cycle and groups discovery if it changed
+        """
+        zhost = self._args.aggregate_host
+
+        key = 'qsan.sanos4.discovery.group'
+        groups = sorted(set(g for g in self._groups.values() if g is not None))
+        data = {'data': [{'{#GROUP}': group} for group in groups]}
+
+        if not self._state or self._state.changed(key, data):
+            self._output(['\t'.join([zhost, key,
+                                     json.dumps(data, sort_keys=True,
+                                                separators=(',', ':'))])])
+            self._unconfirmed = (key, data)
+
+        self._output(rollup.lines(zhost))
+
+    def _aggregate(self, final=False):
+        """
+        Sending aggregates of cycles all storages reported for and of
+        cycles which should have finished an interval ago. Waiting
+        cycles are sent if final
+        """
+        for cycle in sorted(self._rollups):
+            rollup = self._rollups[cycle]
+            overdue = (self._args.interval and time.time() >=
+                       self._epoch + (cycle + 2) * self._args.interval)
+
+            if not (final or overdue or rollup.arrays() == len(self._groups)):
+                break
+
+            del self._rollups[cycle]
+            self._aggregated = cycle
+            self._send_aggregates(rollup)
+
+    def _flush(self):
+        """
+        Pushing batched stats
+        """
+        if self._sender:
+            delivered = self._sender.flush(self._args.zhost or
+                                           self._args.aggregate_host)
+
+            # Spooled discovery may be evicted, so it's sent again until
+            # it's delivered
+            if self._state and self._unconfirmed:
+                if delivered:
+                    self._state.sent(*self._unconfirmed)
+                    self._state.save()
+                self._unconfirmed = None
+        else:
+            sys.stdout.flush()
+
+    def run(self):
+        """
+        Running until workers finish args.cycles collections
+        """
+        for index, shard in self.shards.items():
+            if shard:
+                self._start(index)
+
+        flushed = time.time()
+        try:
+            while True:
+                try:
+                    host, cycle, lines = self._results.get(timeout=1)
+                    self._output(lines)
+
+                    # Late stats of already aggregated cycles are skipped
+                    if self._args.aggregate_host and cycle > self._aggregated:
+                        self._rollups.setdefault(cycle, Rollup()).add(
+                            host, self._groups.get(host), lines)
+                except queue.Empty:
+                    pass
+
+                self._aggregate()
+
+                if time.time() - flushed >= self._args.flush_interval:
+                    self._flush()
+                    flushed = time.time()
+
+                if not self._check() and self._results.empty():
+                    break
+        finally:
+            self._aggregate(final=True)
+            self._flush()
+
+            for p in self._processes.values():
+                if p.is_alive():
+                    p.terminate()
+
+
+def main():
+    """
+    """
+    args = argumentsparsing()
+
+    sender = None
+    if args.zserver:
+        spool = None
+        if args.spool_dir:
+            try:
+                spool = Spool(args.spool_dir, args.spool_max_bytes,
+                              args.spool_max_age)
+            except (IOError, OSError) as e:
+                # Stats are still pushed, only not spooled
+                sys.stderr.write('Spool is disabled: %s\n' % e)
+
+        sender = ZabbixSender(args.zserver, args.zsender, spool,
+                              args.spool_chunk)
+
+    try:
+        Supervisor(args, read_arrays(args.arrays), sender).run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
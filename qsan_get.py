@@ -0,0 +1,73 @@
+# encoding: utf8
+"""
+Client of qsan.py --method serve. Prints latest value of Zabbix item key
+without requesting storage:
+
+    $ python qsan_get.py --socket /run/qsan/storage1.sock \
+        'qsan.sanos4.disk.latency[Slot_7_SEAGATE_ST3840FM0043_Z4F01F5S]'
+
+Uses only standard library to start fast from Zabbix agent UserParameter.
+"""
+import argparse
+import socket
+import sys
+
+
+def argumentsparsing():
+    """
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", dest="socket", required=True, type=str,
+                        help="Socket of qsan.py --method serve")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=1,
+                        help="Seconds to wait for answer " +
+                             "[default: %(default)s]")
+    parser.add_argument("key", type=str,
+                        help="Item key, ex.: qsan.sanos4.storage.iops")
+
+    return parser.parse_args()
+
+
+def get(path, key, timeout=1):
+    """
+    Returns: latest value of key or None if key is unknown
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+
+    try:
+        s.connect(path)
+        s.sendall((key + '\n').encode('utf8'))
+
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        s.close()
+
+    return data.decode('utf8').rstrip('\n') or None
+
+
+def main():
+    """
+    """
+    args = argumentsparsing()
+
+    try:
+        value = get(args.socket, args.key, args.timeout)
+    except (socket.error, socket.timeout) as e:
+        sys.stderr.write('Unable to query %s: %s\n' % (args.socket, e))
+        sys.exit(1)
+
+    if value is None:
+        sys.stderr.write('Unknown key: %s\n' % args.key)
+        sys.exit(1)
+
+    print(value)
+
+
+if __name__ == '__main__':
+    main()
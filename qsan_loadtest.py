@@ -0,0 +1,318 @@
+# encoding: utf8
+"""
+Load test of the collector with a fleet of emulated arrays (qsan_mock.py).
+Finds how many arrays one collector host can poll before cycles overrun:
+
+    $ python qsan_loadtest.py --arrays 100 --latency 0.05 --mode oneshot
+
+Modes:
+ * oneshot - a separate qsan.py process for every array, all started at
+   once every cycle like cron does
+ * longrun - one process polling arrays one by one with QSAN objects
+   kept between cycles and collecting stats:all items with Zabbix like
+   qsan_fleet.py workers do
+ * async - one process polling all arrays concurrently with AsyncQSAN
+   objects kept between cycles (requires aiohttp). Measures only
+   AsyncQSAN.snapshot(), Zabbix output isn't used
+
+Every mode runs one warm-up cycle which is not measured.
+"""
+import argparse
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from qsan import QSAN, Zabbix
+from qsan_fleet import _Lines
+from qsan_mock import MockFleet
+
+QSAN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qsan.py')
+
+
+def argumentsparsing():
+    """
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", dest="mode", type=str, default="oneshot",
+                        choices=["oneshot", "longrun", "async"],
+                        help="Collector mode [default: %(default)s]")
+    parser.add_argument("--arrays", dest="arrays", type=int, default=20,
+                        help="Number of emulated arrays " +
+                             "[default: %(default)s]")
+    parser.add_argument("--volumes", dest="volumes", type=int, default=8,
+                        help="Volumes per array [default: %(default)s]")
+    parser.add_argument("--disks", dest="disks", type=int, default=24,
+                        help="Disks per array [default: %(default)s]")
+    parser.add_argument("--fc-ports", dest="fc_ports", type=int, default=2,
+                        help="FC ports per controller " +
+                             "[default: %(default)s]")
+    parser.add_argument("--cache-pools", dest="cache_pools", type=int,
+                        default=1,
+                        help="Cache pools per array [default: %(default)s]")
+    parser.add_argument("--latency", dest="latency", type=float,
+                        default=0.05,
+                        help="Array response latency in seconds " +
+                             "[default: %(default)s]")
+    parser.add_argument("--mock-processes", dest="mock_processes", type=int,
+                        default=1,
+                        help="Processes serving emulated arrays " +
+                             "[default: %(default)s]")
+    parser.add_argument("--cycles", dest="cycles", type=int, default=3,
+                        help="Measured collection cycles " +
+                             "[default: %(default)s]")
+    parser.add_argument("--interval", dest="interval", type=float,
+                        default=60,
+                        help="Collection interval, longer cycles are " +
+                             "counted as overruns [default: %(default)s]")
+    parser.add_argument("--method", dest="method", type=str,
+                        default="stats:all",
+                        help="qsan.py method for oneshot mode " +
+                             "[default: %(default)s]")
+    parser.add_argument("--concurrency", dest="concurrency", type=int,
+                        default=2,
+                        help="Max concurrent requests per array in async " +
+                             "mode [default: %(default)s]")
+
+    return parser.parse_args()
+
+
+def percentile(values, p):
+    """
+    Returns: nearest-rank p-th percentile of values
+    """
+    if not values:
+        return 0
+
+    values = sorted(values)
+    k = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+
+    return values[k]
+
+
+class LoadTest():
+    """
+    Running collector cycles against MockFleet and measuring them
+    """
+
+    def __init__(self, args, fleet):
+        """
+        """
+        self._args = args
+        self._fleet = fleet
+        self.cycles = []     # Seconds every cycle took
+        self.latencies = []  # Seconds every array collection took
+        self.errors = 0
+        self.cpu = 0         # CPU seconds of collector
+        self.rss = 0         # Max RSS of collector process, KB
+        self.wall = 0
+        self.requests = 0
+
+    def _measure(self, cycle, in_process=True):
+        """
+        Running warm-up and measured cycles. CPU and RSS are measured for
+        current process if in_process, otherwise cycle measures them
+        """
+        cycle(measure=False)
+
+        requests = self._fleet.requests
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+
+        for _ in range(self._args.cycles):
+            cycle_start = time.time()
+            cycle()
+            self.cycles.append(time.time() - cycle_start)
+
+        self.wall = time.time() - start
+        self.requests = self._fleet.requests - requests
+
+        if in_process:
+            finish = resource.getrusage(resource.RUSAGE_SELF)
+            self.cpu = (finish.ru_utime - usage.ru_utime +
+                        finish.ru_stime - usage.ru_stime)
+            # Linux reports KB
+            self.rss = finish.ru_maxrss
+
+    def oneshot(self):
+        """
+        Separate qsan.py process for every array
+        """
+        devnull = open(os.devnull, 'w')
+        # Discovery cache of emulated arrays must not get to the one of
+        # the collector host or leak to the next run
+        cache_dir = tempfile.mkdtemp(prefix='qsan-loadtest-')
+
+        def cycle(measure=True):
+            start = time.time()
+            processes = {}
+
+            for i, host in enumerate(self._fleet.addresses):
+                p = subprocess.Popen([sys.executable, QSAN_PY,
+                                      '--host', host,
+                                      '--zhost', 'loadtest-' + str(i),
+                                      '--method', self._args.method,
+                                      '--cache-dir', cache_dir],
+                                     stdout=devnull, stderr=devnull)
+                processes[p.pid] = p
+
+            while processes:
+                pid, status, usage = os.wait4(-1, 0)
+                p = processes.pop(pid, None)
+                if p is None:
+                    continue
+                p.returncode = status
+
+                if measure:
+                    self.latencies.append(time.time() - start)
+                    self.cpu += usage.ru_utime + usage.ru_stime
+                    # Linux reports KB
+                    self.rss = max(self.rss, usage.ru_maxrss)
+                    if status:
+                        self.errors += 1
+
+        try:
+            self._measure(cycle, in_process=False)
+        finally:
+            devnull.close()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def longrun(self):
+        """
+        One process polling arrays one by one
+        """
+        storages = [QSAN(host) for host in self._fleet.addresses]
+
+        def cycle(measure=True):
+            for i, storage in enumerate(storages):
+                start = time.time()
+                try:
+                    Zabbix(storage, _Lines()).print_all_stats(
+                        'loadtest-' + str(i))
+                except Exception:
+                    if measure:
+                        self.errors += 1
+
+                if measure:
+                    self.latencies.append(time.time() - start)
+
+        self._measure(cycle)
+
+    def async_(self):
+        """
+        One process polling all arrays concurrently, only snapshots are
+        collected
+        """
+        import asyncio
+        import aiohttp
+        from qsan_async import AsyncQSAN
+
+        loop = asyncio.new_event_loop()
+
+        async def create():
+            connector = aiohttp.TCPConnector(limit=0)
+            storages = [
+                await AsyncQSAN.create(host,
+                                       concurrency=self._args.concurrency,
+                                       connector=connector)
+                for host in self._fleet.addresses
+            ]
+
+            return connector, storages
+
+        async def snapshot(storage, measure):
+            start = time.time()
+            try:
+                await storage.snapshot()
+            except Exception:
+                if measure:
+                    self.errors += 1
+
+            if measure:
+                self.latencies.append(time.time() - start)
+
+        async def snapshots(measure):
+            await asyncio.gather(*[snapshot(storage, measure)
+                                   for storage in storages])
+
+        def cycle(measure=True):
+            loop.run_until_complete(snapshots(measure))
+
+        async def close():
+            for storage in storages:
+                await storage.close()
+            await connector.close()
+
+        connector, storages = loop.run_until_complete(create())
+        try:
+            self._measure(cycle)
+        finally:
+            loop.run_until_complete(close())
+            loop.close()
+
+    def run(self):
+        """
+        Running test in args.mode
+        """
+        modes = {
+            'oneshot': self.oneshot,
+            'longrun': self.longrun,
+            'async': self.async_
+        }
+
+        modes[self._args.mode]()
+
+    def report(self, stream=sys.stdout):
+        """
+        Writing results
+        """
+        args = self._args
+        overruns = len([c for c in self.cycles if c > args.interval])
+
+        stream.write('Mode: %s, arrays: %d, volumes: %d, disks: %d, ' %
+                     (args.mode, args.arrays, args.volumes, args.disks) +
+                     'FC ports: %d, cache pools: %d, latency: %.3fs\n' %
+                     (args.fc_ports, args.cache_pools, args.latency))
+        stream.write('Cycles: %d, overruns (> %gs): %d, errors: %d\n' %
+                     (len(self.cycles), args.interval, overruns,
+                      self.errors))
+        stream.write('Cycle time, s:    p50 %8.3f  p90 %8.3f  max %8.3f\n' %
+                     (percentile(self.cycles, 50),
+                      percentile(self.cycles, 90),
+                      max(self.cycles or [0])))
+        stream.write('Array latency, s: p50 %8.3f  p90 %8.3f  p99 %8.3f  ' %
+                     (percentile(self.latencies, 50),
+                      percentile(self.latencies, 90),
+                      percentile(self.latencies, 99)) +
+                     'max %8.3f\n' % max(self.latencies or [0]))
+        stream.write('CPU: %.2fs (%.1f%% of one core), max RSS: %.1f MB\n' %
+                     (self.cpu,
+                      self.cpu / self.wall * 100 if self.wall else 0,
+                      self.rss / 1024.0))
+        stream.write('Requests: %d, %.1f req/s, %.2f arrays/s\n' %
+                     (self.requests,
+                      self.requests / self.wall if self.wall else 0,
+                      len(self.latencies) / self.wall if self.wall else 0))
+
+
+def main():
+    """
+    """
+    args = argumentsparsing()
+
+    with MockFleet(args.arrays, processes=args.mock_processes,
+                   volumes=args.volumes, disks=args.disks,
+                   fc_ports=args.fc_ports, cache_pools=args.cache_pools,
+                   latency=args.latency) as fleet:
+        test = LoadTest(args, fleet)
+        test.run()
+
+    test.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,523 @@
+# encoding: utf8
+"""
+Emulated QSAN SANOS4 array web-interface.
+
+Serves the XML documents qsan.py parses with a configurable number of
+volumes, disks, FC ports and cache pools and a configurable per-request
+latency. Used for benchmarking and load-testing the collector without a
+real controller:
+
+    $ python qsan_mock.py --port 8080 --volumes 16 --disks 24 --latency 0.05
+    $ python qsan.py --host 127.0.0.1:8080 --method stats:all
+"""
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+def argumentsparsing():
+    """
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bind", dest="bind", type=str, default="127.0.0.1",
+                        help="Address to listen on [default: %(default)s]")
+    parser.add_argument("--port", dest="port", type=int, default=8080,
+                        help="Port to listen on [default: %(default)s]")
+    parser.add_argument("--volumes", dest="volumes", type=int, default=4,
+                        help="Number of volumes [default: %(default)s]")
+    parser.add_argument("--disks", dest="disks", type=int, default=12,
+                        help="Number of disks [default: %(default)s]")
+    parser.add_argument("--fc-ports", dest="fc_ports", type=int, default=2,
+                        help="FC ports per controller [default: %(default)s]")
+    parser.add_argument("--controllers", dest="controllers", type=int,
+                        default=2,
+                        help="Number of controllers [default: %(default)s]")
+    parser.add_argument("--cache-pools", dest="cache_pools", type=int,
+                        default=1,
+                        help="Number of cache pools [default: %(default)s]")
+    parser.add_argument("--sanos", dest="sanos", type=int, default=4,
+                        choices=[3, 4],
+                        help="Emulated SANOS version [default: %(default)s]")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0,
+                        help="Delay in seconds added to every response " +
+                             "[default: %(default)s]")
+
+    return parser.parse_args()
+
+
+class Array():
+    """
+    State of an emulated storage array
+    """
+
+    def __init__(self, volumes=4, disks=12, fc_ports=2, controllers=2,
+                 cache_pools=1, sanos=4, latency=0.0, counter=None):
+        """
+        counter is optional multiprocessing.Value counting requests of
+        many arrays
+        """
+        self.sanos = sanos
+        self.latency = latency
+        self.controllers = controllers
+        self.fc_ports = fc_ports
+        self.requests = 0
+        self._counter = counter
+        self._lock = threading.Lock()
+
+        self.volumes = [str(1000 + i) for i in range(volumes)]
+        self.disks = [str(2000 + i) for i in range(disks)]
+        self.cache_pools = [str(i + 1) for i in range(cache_pools)]
+
+        # Monitoring is disabled until collector enables it
+        self.monitored_volumes = set()
+        self.monitored_disks = set()
+        self.monitored_fcs = set()
+
+    def count(self):
+        """
+        Counting served requests
+        """
+        with self._lock:
+            self.requests += 1
+
+        if self._counter is not None:
+            with self._counter.get_lock():
+                self._counter.value += 1
+
+    def _rate(self):
+        """
+        Returns: random integer rate value
+        """
+        return random.randint(0, 100000)
+
+    def login(self):
+        """
+        Returns: login result page
+        """
+        if self.sanos == 4:
+            logo = '<div id="logo_writing">SANOS 4.0</div>'
+            logout = '<div id="logout_btn">Logout</div>'
+        else:
+            logo = ''
+            logout = '<img title="Logout" src="logout.gif"/>'
+
+        return '<html><body>' + logo + logout + '</body></html>'
+
+    def dashboard(self):
+        """
+        Returns: monitor_dashboard response
+        """
+        if self.sanos == 3:
+            return '<response></response>'
+
+        return ('<response><controller>0</controller>' +
+                '<iops>' + '{:,}'.format(self._rate()) + '</iops>' +
+                '<tx>' + str(self._rate() / 100.0) + '</tx>' +
+                '<rx>' + str(self._rate() / 100.0) + '</rx></response>')
+
+    def health(self):
+        """
+        Returns: system health response
+        """
+        if self.sanos == 3:
+            return ('<html><body><div id="status_led">' +
+                    '<input src="led-green.gif"/>' +
+                    '<input src="led-green.gif"/></div></body></html>')
+
+        return ('<response><data><system><item>System Health</item>' +
+                '<value>Good</value></system></data></response>')
+
+    def vd_list(self):
+        """
+        Returns: volumes list response
+        """
+        udvs = []
+        for i, vd in enumerate(self.volumes):
+            if self.sanos == 4:
+                capacity = '10.48 TB'
+            else:
+                capacity = '11252000'
+            udvs.append('<udv><id>' + vd + '</id>' +
+                        '<name>volume ' + str(i) + '</name>' +
+                        '<raid>RAID 10</raid>' +
+                        '<capacity>' + capacity + '</capacity>' +
+                        '<status>Online</status>' +
+                        '<health>Optimal</health></udv>')
+
+        return ('<response><vd_num>' + str(len(self.volumes)) + '</vd_num>' +
+                ''.join(udvs) + '</response>')
+
+    def vd_stats(self):
+        """
+        Returns: volumes stats response
+        """
+        stats = []
+        for vd in self.volumes:
+            if vd not in self.monitored_volumes:
+                continue
+            stats.append('<volume_stats><vd_id>' + vd + '</vd_id>' +
+                         '<iops_rate>' + str(self._rate()) + '</iops_rate>' +
+                         '<tx_rate>' + str(self._rate()) + '</tx_rate>' +
+                         '<rx_rate>' + str(self._rate()) + '</rx_rate>' +
+                         '</volume_stats>')
+
+        return '<response>' + ''.join(stats) + '</response>'
+
+    def disk_list(self):
+        """
+        Returns: disks list response
+        """
+        hdds = []
+        for i, disk in enumerate(self.disks):
+            model = ''
+            if self.sanos == 4:
+                model = '<model>ST3840FM0043</model>'
+            hdds.append('<hdd><id>' + disk + '</id>' +
+                        '<slot>' + str(i + 1) + '</slot>' +
+                        '<size>3.49 TB</size>' +
+                        '<health>Good</health>' +
+                        '<fw_ver>0007</fw_ver>' +
+                        '<rate>SAS SSD    12.0Gb/s</rate>' +
+                        '<vendor>SEAGATE</vendor>' + model +
+                        '<serial>Z4' + disk + '</serial></hdd>')
+
+        return '<response>' + ''.join(hdds) + '</response>'
+
+    def disk_stats(self):
+        """
+        Returns: disks stats response
+        """
+        stats = []
+        for i, disk in enumerate(self.disks):
+            slot = str(i + 1)
+            enabled = 'Yes' if slot in self.monitored_disks else 'No'
+            stats.append('<disk_monitor_stats><slot>' + slot + '</slot>' +
+                         '<is_enabled>' + enabled + '</is_enabled>' +
+                         '<latency>' + str(self._rate() % 100) +
+                         '</latency>' +
+                         '<thruput>' + str(self._rate()) + '</thruput>' +
+                         '</disk_monitor_stats>')
+
+        return '<response>' + ''.join(stats) + '</response>'
+
+    def fc_list(self, controller):
+        """
+        Returns: FC ports list response of given controller
+        """
+        if int(controller) >= self.controllers or not self.fc_ports:
+            return ''
+
+        ports = []
+        for port in range(self.fc_ports):
+            if self.sanos == 4:
+                name = 'FC' + str(port + 1) + ' (16Gb)'
+            else:
+                name = 'Port ' + str(port + 1)
+            ports.append('<fc_port_value><name>' + name + '</name>' +
+                         '<ctr>CTR' + str(int(controller) + 1) + '</ctr>' +
+                         '<status>Link Up</status>' +
+                         '<data_rate>16Gb</data_rate></fc_port_value>')
+
+        return '<response>' + ''.join(ports) + '</response>'
+
+    def fc_stats(self):
+        """
+        Returns: FC ports stats response
+        """
+        ctrls = []
+        for controller in range(self.controllers):
+            ports = []
+            for port in range(self.fc_ports):
+                pid = str(controller) + ':' + str(port)
+                enabled = 'Yes' if pid in self.monitored_fcs else 'No'
+                ports.append('<fcport_stats>' +
+                             '<port_idx>' + str(port) + '</port_idx>' +
+                             '<is_enabled>' + enabled + '</is_enabled>' +
+                             '<num_rates>1</num_rates>' +
+                             '<tx>' + str(self._rate()) + '</tx>' +
+                             '<rx>' + str(self._rate()) + '</rx>' +
+                             '</fcport_stats>')
+            ctrls.append('<ctrl_fcport_info><ctrl_idx>' + str(controller) +
+                         '</ctrl_idx>' + ''.join(ports) +
+                         '</ctrl_fcport_info>')
+
+        return '<response>' + ''.join(ctrls) + '</response>'
+
+    def cp_list(self):
+        """
+        Returns: cache pools list response
+        """
+        pools = []
+        for cp in self.cache_pools:
+            pools.append('<ssdpoollist><ssd_name>Pool ' + cp + '</ssd_name>' +
+                         '<rg_id>' + cp + '</rg_id>' +
+                         '<rg_name>RG' + cp + '</rg_name></ssdpoollist>')
+
+        return '<response>' + ''.join(pools) + '</response>'
+
+    def cp_stats(self):
+        """
+        Returns: cache pools stats response
+        """
+        pools = []
+        vols = []
+        for cp in self.cache_pools:
+            pools.append('<pool_data><rg_id>' + cp + '</rg_id>' +
+                         '<name>Pool-' + cp + '</name>' +
+                         '<rg_name>RG' + cp + '</rg_name></pool_data>')
+            hits = self._rate()
+            vols.append('<vol_data><vd>' + cp + '</vd>' +
+                        '<rg>' + cp + '</rg>' +
+                        '<size_alloc>102400</size_alloc>' +
+                        '<size_cached>' + str(hits % 102400) +
+                        '</size_cached>' +
+                        '<size_dirty>' + str(hits % 1024) + '</size_dirty>' +
+                        '<log_rd_hit>' + str(hits) + '</log_rd_hit>' +
+                        '<log_rd_tot>' + str(hits + self._rate() + 1) +
+                        '</log_rd_tot></vol_data>')
+
+        return '<response>' + ''.join(pools) + ''.join(vols) + '</response>'
+
+    def set_monitor(self, query):
+        """
+        Enabling monitoring as requested by collector
+        """
+        if 'volume_arr' in query:
+            self.monitored_volumes.update(query['volume_arr'][0].split(','))
+        if 'slot_arr' in query:
+            self.monitored_disks.update(query['slot_arr'][0].split(','))
+        if 'fibre_arr' in query:
+            self.monitored_fcs.update(query['fibre_arr'][0].split(','))
+        if 'ctrl_idx' in query and 'port_idx' in query:
+            self.monitored_fcs.add(query['ctrl_idx'][0] + ':' +
+                                   query['port_idx'][0])
+
+        return '<response><result>0</result></response>'
+
+    def handle(self, path, query):
+        """
+        Dispatching request to response generator
+        Returns: response body or None if path is unknown
+        """
+        cmd = query.get('cmd', [''])[0]
+        op = query.get('op', [''])[0]
+        q = query.get('query', [''])[0]
+
+        if path == '/login.php':
+            return self.login()
+        if path == '/index.php':
+            return self.health()
+        if path == '/dashboard_x.php':
+            return self.health()
+        if path == '/vd_x.php':
+            return self.vd_list()
+        if path == '/pd_x.php':
+            return self.disk_list()
+        if path == '/fc_x.php':
+            return self.fc_list(query.get('ctrl_idx', ['0'])[0])
+        if path == '/ssd_cache_pool_x.php':
+            if q == 'get_statistics':
+                return self.cp_stats()
+            return self.cp_list()
+        if path == '/monitor_x.php':
+            if op or 'ctrl_idx' in query:
+                return self.set_monitor(query)
+            if cmd == 'monitor_dashboard':
+                return self.dashboard()
+            if cmd == 'monitor_volume':
+                return self.vd_stats()
+            if cmd == 'monitor_disk':
+                return self.disk_stats()
+            if cmd == 'monitor_fcport':
+                return self.fc_stats()
+
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    HTTP requests handler serving Array responses
+    """
+
+    def _reply(self):
+        """
+        Common reply method for GET and POST requests
+        """
+        self.server.array.count()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf8')
+            query.update(parse_qs(body))
+
+        if self.server.array.latency:
+            time.sleep(self.server.array.latency)
+
+        body = self.server.array.handle(url.path, query)
+        if body is None:
+            self.send_response(404)
+            body = ''
+        else:
+            self.send_response(200)
+        body = body.encode('utf8')
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply()
+
+    def do_POST(self):
+        self._reply()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server emulating one QSAN array
+    """
+    daemon_threads = True
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, array, bind='127.0.0.1', port=0):
+        """
+        Port 0 binds to any free port, see self.address
+        """
+        HTTPServer.__init__(self, (bind, port), _Handler)
+        self.array = array
+
+    @property
+    def address(self):
+        """
+        Returns: 'ip:port' usable as QSAN host
+        """
+        return '%s:%d' % self.server_address[:2]
+
+    def start(self):
+        """
+        Serving in background thread
+        """
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+        return self
+
+
+def _serve_fleet(arrays, bind, kwargs, counter, queue, stop):
+    """
+    Serving arrays until stop is set. Addresses are put to queue
+    """
+    servers = [MockServer(Array(counter=counter, **kwargs), bind).start()
+               for _ in range(arrays)]
+    queue.put([server.address for server in servers])
+
+    stop.wait()
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+class MockFleet():
+    """
+    Number of emulated arrays served by separate processes so they don't
+    compete for GIL with the collector under test
+    """
+
+    def __init__(self, arrays=1, bind='127.0.0.1', processes=1, **kwargs):
+        """
+        Arrays are spread over processes, kwargs are passed to Array()
+        """
+        self._arrays = arrays
+        self._bind = bind
+        self._processes = []
+        self._processes_count = max(min(processes, arrays), 1)
+        self._kwargs = kwargs
+        self._counter = multiprocessing.Value('L', 0)
+        self._stop = None
+        self.addresses = []
+
+    @property
+    def requests(self):
+        """
+        Returns: number of requests served by all arrays
+        """
+        return self._counter.value
+
+    def start(self):
+        """
+        Starting serving processes
+        Returns: self with self.addresses filled
+        """
+        queue = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+
+        for i in range(self._processes_count):
+            arrays = (self._arrays // self._processes_count +
+                      (1 if i < self._arrays % self._processes_count else 0))
+            process = multiprocessing.Process(
+                target=_serve_fleet,
+                args=(arrays, self._bind, self._kwargs, self._counter, queue,
+                      self._stop))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+        for _ in self._processes:
+            self.addresses.extend(queue.get(timeout=60))
+
+        return self
+
+    def stop(self):
+        """
+        Stopping serving processes
+        """
+        self._stop.set()
+        for process in self._processes:
+            process.join(10)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    """
+    """
+    args = argumentsparsing()
+
+    array = Array(volumes=args.volumes, disks=args.disks,
+                  fc_ports=args.fc_ports, controllers=args.controllers,
+                  cache_pools=args.cache_pools, sanos=args.sanos,
+                  latency=args.latency)
+    server = MockServer(array, args.bind, args.port)
+    print('Serving emulated SANOS' + str(args.sanos) + ' array on ' +
+          server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()